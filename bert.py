@@ -1,21 +1,299 @@
+import argparse
+import hashlib
+import json
 import os
 import pickle
+import socketserver
 import stat
 import sys
 import time as t
+from concurrent.futures import Future
 from io import BytesIO
+from queue import Empty, Queue
+from threading import Thread
+from typing import Callable
 
 import numpy as np
-import torch
-from sentence_transformers import SentenceTransformer
+
+from utils.embedding_utils import (
+    DEFAULT_MODEL,
+    DEFAULT_SOCKET_PATH,
+    ERROR_FRAME,
+    REPLY_FRAME,
+    REQUEST_FRAME,
+    STATS_FRAME,
+    RAW_DTYPE_CODES,
+    REPLY_FORMATS,
+    EmbeddingError,
+    decode_request,
+    encode_npy_reply,
+    encode_raw_reply,
+    read_frame,
+    send_frame,
+)
+from utils.metrics_utils import (
+    RATIO_BUCKETS,
+    SIZE_BUCKETS,
+    registry,
+    start_metrics,
+    stop_metrics,
+)
 
 REQUEST_FILE = "request.fifo"
 REPLY_FILE = "reply.fifo"
 
+requests_total = registry.counter(
+    "embedder_requests_total", "Embedding requests recieved."
+)
+sentences_total = registry.counter(
+    "embedder_sentences_total", "Sentences embedded by the model."
+)
+truncated_total = registry.counter(
+    "embedder_truncated_sentences_total", "Sentences truncated to --max-seq-length."
+)
+encode_seconds = registry.histogram(
+    "embedder_encode_seconds", "Time spent encoding one coalesced batch or request."
+)
+batch_sentences = registry.histogram(
+    "embedder_batch_sentences", "Sentences per coalesced model call.", SIZE_BUCKETS
+)
+queue_wait_seconds = registry.histogram(
+    "embedder_queue_wait_seconds", "Time requests wait in the micro-batching queue."
+)
+queue_depth = registry.gauge(
+    "embedder_queue_depth", "Requests waiting in the micro-batching queue."
+)
+padding_ratio = registry.histogram(
+    "embedder_padding_ratio", "Share of padding tokens per forward pass.", RATIO_BUCKETS
+)
+tokens_total = registry.counter(
+    "embedder_tokens_total", "Sentence tokens encoded, excluding padding."
+)
+padded_tokens_total = registry.counter(
+    "embedder_padded_tokens_total", "Tokens encoded including padding."
+)
+
+
+QUANTIZATION_CHECK_SENTENCES = [
+    "Metformin: A Possible Option in Cancer Chemotherapy",
+    "Combination Immunotherapy Approaches for Pancreatic Cancer Treatment",
+    "Alginate-Based Platforms for Cancer-Targeted Drug Delivery",
+    "A Review of Penile Cancer",
+    "Progress in Personalizing Chemotherapy for Bladder Cancer",
+    "Deep learning for protein structure prediction",
+    "Groundwater contamination in semi-arid agricultural regions",
+    "A survey of transformer architectures for natural language processing",
+]
+
+
+def record_padding(lengths: np.ndarray, truncated: int) -> float:
+    padded = len(lengths) * int(lengths.max())
+    ratio = 1 - int(lengths.sum()) / padded if padded else 0.0
+    padding_ratio.observe(ratio)
+    truncated_total.inc(truncated)
+    tokens_total.inc(int(lengths.sum()))
+    padded_tokens_total.inc(padded)
+    return ratio
+
+
+def stats_snapshot() -> dict[str, object]:
+    """Summarizes the embedder metrics for STATS replies and periodic reports."""
+    metrics = registry.snapshot()
+    counters = metrics["counters"]
+    histograms = metrics["histograms"]
+    batch_size = histograms[batch_sentences.name]
+    queue_wait = histograms[queue_wait_seconds.name]
+    encode_time = histograms[encode_seconds.name]
+    padding = histograms[padding_ratio.name]
+    tokens = counters[tokens_total.name]
+    padded_tokens = counters[padded_tokens_total.name]
+    return {
+        "requests": int(counters[requests_total.name]),
+        "batches": batch_size["count"],
+        "sentences": int(counters[sentences_total.name]),
+        "mean_batch_size": batch_size["mean"] or 0,
+        "mean_queue_wait": queue_wait["mean"] or 0,
+        "mean_encode_time": encode_time["mean"] or 0,
+        "batch_size": batch_size,
+        "queue_wait": queue_wait,
+        "encode_time": encode_time,
+        "padding": {
+            "batches": padding["count"],
+            "truncated": int(counters[truncated_total.name]),
+            "tokens": int(tokens),
+            "padded_tokens": int(padded_tokens),
+            "padding_ratio": 1 - tokens / padded_tokens if padded_tokens else 0,
+            "padding_ratio_histogram": padding,
+        },
+    }
+
+
+class LengthBucketer:
+    """
+    Splits sentences into model batches of similar token length.
+
+    Every batch is padded to its longest sentence, so sorting by length before
+    slicing keeps short titles from being padded to the length of long ones.
+    Embeddings are scattered back into the original sentence order.
+    """
+
+    def __init__(
+        self, batch_size: int = 32, max_seq_length: int = 0, enabled: bool = True
+    ) -> None:
+        self.batch_size = batch_size
+        self.max_seq_length = max_seq_length
+        self.enabled = enabled
+
+    def batches(self, lengths: np.ndarray) -> list[np.ndarray]:
+        if self.enabled:
+            order = np.argsort(lengths, kind="stable")
+        else:
+            order = np.arange(len(lengths))
+        return [
+            order[i : i + self.batch_size]
+            for i in range(0, len(order), self.batch_size)
+        ]
+
+    def encode(
+        self,
+        sentences: list[str],
+        lengths: list[int],
+        encode_batch: Callable[[list[str]], np.ndarray],
+    ) -> np.ndarray:
+        token_lengths = np.asarray(lengths, dtype=np.int64)
+        truncated = np.zeros(len(token_lengths), dtype=bool)
+        if self.max_seq_length > 0:
+            truncated = token_lengths > self.max_seq_length
+            token_lengths = np.minimum(token_lengths, self.max_seq_length)
+
+        embeddings: np.ndarray | None = None
+        for indices in self.batches(token_lengths):
+            embedding = encode_batch([sentences[i] for i in indices])
+            if embeddings is None:
+                embeddings = np.empty(
+                    (len(sentences), embedding.shape[1]), dtype=embedding.dtype
+                )
+            embeddings[indices] = embedding
+            record_padding(token_lengths[indices], int(truncated[indices].sum()))
+
+        if embeddings is None:
+            return np.empty((0, 0), dtype=np.float32)
+        return embeddings
+
+
+class SentenceTransformerBackend:
+    def __init__(
+        self,
+        model_name: str = DEFAULT_MODEL,
+        device: str = "auto",
+        threads: int = 0,
+        interop_threads: int = 0,
+        quantize: bool = False,
+        check_sentences: list[str] | None = None,
+        bucketer: LengthBucketer | None = None,
+    ) -> None:
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        self._torch = torch
+        if interop_threads > 0:
+            torch.set_num_interop_threads(interop_threads)
+        if threads > 0:
+            torch.set_num_threads(threads)
+
+        if device == "auto":
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        print(
+            f"Using device: {self.device} (intra-op threads: {torch.get_num_threads()}, "
+            f"inter-op threads: {torch.get_num_interop_threads()})"
+        )
+
+        print("Loading model...")
+        start = t.perf_counter()
+        self.model = SentenceTransformer(model_name, device=str(self.device))
+        self.model.eval()
+        print(f"Model loaded in: {t.perf_counter() - start}")
+
+        self.bucketer = bucketer or LengthBucketer()
+        if self.bucketer.max_seq_length > 0:
+            self.model.max_seq_length = self.bucketer.max_seq_length
+        else:
+            self.bucketer.max_seq_length = self.model.max_seq_length or 0
+
+        if quantize:
+            self._quantize(check_sentences or QUANTIZATION_CHECK_SENTENCES)
+
+    def _quantize(self, check_sentences: list[str]):
+        if self.device.type != "cpu":
+            print("Dynamic int8 quantization is only supported on CPU. Skipping...")
+            return
+
+        print("Applying dynamic int8 quantization to linear layers...")
+        reference = self.encode(check_sentences)
+        self.model = self._torch.quantization.quantize_dynamic(
+            self.model, {self._torch.nn.Linear}, dtype=self._torch.qint8
+        )
+        quantized = self.encode(check_sentences)
+
+        similarity = np.sum(reference * quantized, axis=1) / (
+            np.linalg.norm(reference, axis=1) * np.linalg.norm(quantized, axis=1)
+        )
+        print(
+            f"Quantized vs fp32 cosine similarity over {len(check_sentences)} sentences: "
+            f"mean {similarity.mean():.5f}, min {similarity.min():.5f}"
+        )
+
+    def token_lengths(self, sentences: list[str]) -> list[int]:
+        encoded = self.model.tokenizer(sentences, truncation=False, verbose=False)
+        return [len(ids) for ids in encoded["input_ids"]]
+
+    def _encode_batch(self, sentences: list[str]) -> np.ndarray:
+        return self.model.encode(
+            sentences,
+            batch_size=len(sentences),
+            device=str(self.device),
+            show_progress_bar=False,
+        )
+
+    def encode(self, sentences: list[str]) -> np.ndarray:
+        with self._torch.inference_mode():
+            return self.bucketer.encode(
+                sentences, self.token_lengths(sentences), self._encode_batch
+            )
+
+
+class FakeBackend:
+    """Deterministic, model-free backend used for testing the embedding service."""
+
+    def __init__(
+        self, dimensions: int = 768, bucketer: LengthBucketer | None = None
+    ) -> None:
+        self.dimensions = dimensions
+        self.bucketer = bucketer or LengthBucketer()
+
+    def token_lengths(self, sentences: list[str]) -> list[int]:
+        # Whitespace tokens plus the [CLS] and [SEP] markers a BERT tokenizer adds.
+        return [len(sentence.split()) + 2 for sentence in sentences]
+
+    def encode(self, sentences: list[str]) -> np.ndarray:
+        return self.bucketer.encode(
+            sentences, self.token_lengths(sentences), self._encode_batch
+        )
+
+    def _encode_batch(self, sentences: list[str]) -> np.ndarray:
+        embeddings = np.empty((len(sentences), self.dimensions), dtype=np.float32)
+        for i, sentence in enumerate(sentences):
+            seed = hashlib.sha256(sentence.encode("utf-8")).digest()[:8]
+            rng = np.random.default_rng(int.from_bytes(seed, "big"))
+            embeddings[i] = rng.standard_normal(self.dimensions, dtype=np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings
+
 
 def check_and_create_fifo(path: str):
     if os.path.exists(path):
-        if not stat.S_ISFIFO(os.stat(REQUEST_FILE).st_mode):
+        if not stat.S_ISFIFO(os.stat(path).st_mode):
             print(f"{path} is not a pipe.")
             return False
         return True
@@ -24,28 +302,393 @@ def check_and_create_fifo(path: str):
         return True
 
 
-if not check_and_create_fifo(REQUEST_FILE) or not check_and_create_fifo(REPLY_FILE):
-    sys.exit(0)
+def encode_reply(embedding: np.ndarray, reply_format: str, reply_dtype: str):
+    if reply_format == "raw":
+        return encode_raw_reply(embedding, reply_dtype)
+    return (encode_npy_reply(embedding),)
 
-print("Loading model...")
-start = t.perf_counter()
-device = torch.device("cuda")
-model = SentenceTransformer("bert-base-nli-mean-tokens").to(device)
-print(f"Model loaded in: {t.perf_counter() - start}")
 
-while True:
-    with open(REQUEST_FILE, "rb") as f:
-        buffer = BytesIO(f.read())
-        buffer.seek(0)
-        data: list[str] = pickle.load(buffer)
-        print(f"Number of sentences: {len(data)}")
-        print("Generating embeddings...")
-        start = t.perf_counter()
-        embedding = model.encode(data, device=device, show_progress_bar=True)
-        print(f"Total embedding length: {len(embedding)}")
-        print(f"Embeddings generated in: {t.perf_counter() - start}")
-    with open(REPLY_FILE, "wb") as fd:
-        buffer = BytesIO()
-        np.save(buffer, embedding)
-        buffer.seek(0)
-        fd.write(buffer.read())
+def serve_fifo(
+    backend,
+    request_file: str,
+    reply_file: str,
+    reply_format: str = "npy",
+    reply_dtype: str = "float32",
+):
+    if not check_and_create_fifo(request_file) or not check_and_create_fifo(reply_file):
+        sys.exit(0)
+
+    while True:
+        with open(request_file, "rb") as f:
+            buffer = BytesIO(f.read())
+            buffer.seek(0)
+            data: list[str] = pickle.load(buffer)
+            print(f"Number of sentences: {len(data)}")
+            print("Generating embeddings...")
+            start = t.perf_counter()
+            embedding = backend.encode(data)
+            took = t.perf_counter() - start
+            requests_total.inc()
+            sentences_total.inc(len(data))
+            encode_seconds.observe(took)
+            batch_sentences.observe(len(data))
+            print(f"Total embedding length: {len(embedding)}")
+            print(f"Embeddings generated in: {took}")
+            padding = stats_snapshot()["padding"]
+            print(
+                f"Padding ratio: {padding['padding_ratio']:.3f} over {padding['batches']} batches, "
+                f"truncated sentences: {padding['truncated']}"
+            )
+        with open(reply_file, "wb") as fd:
+            for part in encode_reply(embedding, reply_format, reply_dtype):
+                fd.write(part)
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent embedding requests into shared model calls.
+
+    A batch is closed once it holds max_batch_size sentences or max_wait seconds
+    have passed since its first request arrived. Requests larger than
+    max_batch_size are encoded on their own.
+    """
+
+    def __init__(self, backend, max_batch_size: int = 64, max_wait: float = 0.005):
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue: Queue[tuple[list[str], Future, float]] = Queue()
+        self._carry: tuple[list[str], Future, float] | None = None
+        self._thread = Thread(target=self._run, name="MicroBatcher", daemon=True)
+        self._thread.start()
+        queue_depth.set_function(self._queue.qsize)
+
+    def submit(self, sentences: list[str]) -> Future:
+        future: Future = Future()
+        self._queue.put((sentences, future, t.perf_counter()))
+        return future
+
+    def encode(self, sentences: list[str]) -> np.ndarray:
+        return self.submit(sentences).result()
+
+    def _next_batch(self) -> list[tuple[list[str], Future, float]]:
+        if self._carry is not None:
+            first, self._carry = self._carry, None
+        else:
+            first = self._queue.get()
+        batch = [first]
+        size = len(first[0])
+        deadline = t.perf_counter() + self.max_wait
+
+        while size < self.max_batch_size:
+            remaining = deadline - t.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except Empty:
+                break
+            if size + len(item[0]) > self.max_batch_size:
+                self._carry = item
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            started = t.perf_counter()
+            sentences = [sentence for item in batch for sentence in item[0]]
+            try:
+                embedding = self.backend.encode(sentences)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            took = t.perf_counter() - started
+            waits = [started - item[2] for item in batch]
+            requests_total.inc(len(batch))
+            sentences_total.inc(len(sentences))
+            encode_seconds.observe(took)
+            batch_sentences.observe(len(sentences))
+            for wait in waits:
+                queue_wait_seconds.observe(wait)
+            offset = 0
+            for item_sentences, future, _ in batch:
+                future.set_result(embedding[offset : offset + len(item_sentences)])
+                offset += len(item_sentences)
+
+
+class EmbeddingRequestHandler(socketserver.BaseRequestHandler):
+    server: "EmbeddingServer"
+
+    def handle(self):
+        while True:
+            frame = read_frame(self.request)
+            if frame is None:
+                return
+            request_id, kind, payload = frame
+
+            try:
+                if kind == STATS_FRAME:
+                    reply = (json.dumps(stats_snapshot()).encode(),)
+                elif kind == REQUEST_FRAME:
+                    sentences, reply_format, reply_dtype = decode_request(payload)
+                    embedding = self.server.batcher.encode(sentences)
+                    reply = encode_reply(embedding, reply_format, reply_dtype)
+                else:
+                    raise EmbeddingError(f"Unexpected frame kind: {kind}.")
+            except Exception as e:
+                send_frame(self.request, request_id, ERROR_FRAME, str(e).encode())
+                continue
+
+            send_frame(self.request, request_id, REPLY_FRAME, *reply)
+
+
+class EmbeddingServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, batcher: MicroBatcher) -> None:
+        self.batcher = batcher
+        super().__init__(socket_path, EmbeddingRequestHandler)
+
+
+def report_stats(interval: float):
+    while True:
+        t.sleep(interval)
+        stats = stats_snapshot()
+        print(
+            f"Batches: {stats['batches']}, requests: {stats['requests']}, "
+            f"mean batch size: {stats['mean_batch_size']:.2f}, "
+            f"mean queue wait: {stats['mean_queue_wait']:.4f}, "
+            f"mean encode time: {stats['mean_encode_time']:.4f}, "
+            f"padding ratio: {stats['padding']['padding_ratio']:.3f}"
+        )
+
+
+def serve_socket(
+    backend,
+    socket_path: str,
+    max_batch_size: int = 64,
+    max_wait: float = 0.005,
+    stats_interval: float = 0,
+):
+    if os.path.exists(socket_path):
+        if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            print(f"{socket_path} is not a socket.")
+            sys.exit(0)
+        os.remove(socket_path)
+
+    batcher = MicroBatcher(backend, max_batch_size, max_wait)
+    if stats_interval > 0:
+        Thread(
+            target=report_stats,
+            args=(stats_interval,),
+            name="StatsReporter",
+            daemon=True,
+        ).start()
+
+    with EmbeddingServer(socket_path, batcher) as server:
+        print(f"Serving embeddings on: {socket_path}")
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        "Embedding Server",
+        allow_abbrev=False,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "-m",
+        "--mode",
+        choices=("fifo", "socket"),
+        default="fifo",
+        help="Serve requests over the named pipe pair or a Unix domain socket.",
+    )
+    parser.add_argument(
+        "-u",
+        "--socket-path",
+        type=str,
+        default=DEFAULT_SOCKET_PATH,
+        help="Path of the Unix domain socket used in socket mode.",
+    )
+    parser.add_argument(
+        "-r",
+        "--request-file",
+        type=str,
+        default=REQUEST_FILE,
+        help="Named pipe used for recieving requests in fifo mode.",
+    )
+    parser.add_argument(
+        "-s",
+        "--reply-file",
+        type=str,
+        default=REPLY_FILE,
+        help="Named pipe used for sending replies in fifo mode.",
+    )
+    parser.add_argument(
+        "--reply-format",
+        choices=REPLY_FORMATS,
+        default="npy",
+        help="Reply format used in fifo mode. Socket clients choose their own format per request.",
+    )
+    parser.add_argument(
+        "--reply-dtype",
+        choices=tuple(RAW_DTYPE_CODES),
+        default="float32",
+        help="Float precision of raw replies in fifo mode.",
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=64,
+        help="Maximum number of sentences coalesced into one model call in socket mode.",
+    )
+    parser.add_argument(
+        "--max-wait-ms",
+        type=float,
+        default=5,
+        help="Maximum time in milliseconds a request waits for others to join its batch.",
+    )
+    parser.add_argument(
+        "--stats-interval",
+        type=float,
+        default=0,
+        help="Seconds between printed batching statistics (0 disables them).",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=0,
+        help="Port serving Prometheus metrics at /metrics (0 disables it).",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=str,
+        help="Path of a JSON metrics snapshot rewritten periodically.",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=10,
+        help="Seconds between JSON metrics snapshots.",
+    )
+    parser.add_argument(
+        "--encode-batch-size",
+        type=int,
+        default=32,
+        help="Maximum number of sentences passed to the model in one forward pass.",
+    )
+    parser.add_argument(
+        "--max-seq-length",
+        type=int,
+        default=0,
+        help="Truncate sentences to this many tokens (0 keeps the model's own limit).",
+    )
+    parser.add_argument(
+        "--no-length-buckets",
+        action="store_true",
+        help="Batch sentences in request order instead of grouping them by token length.",
+    )
+    parser.add_argument(
+        "--model",
+        type=str,
+        default=DEFAULT_MODEL,
+        help="SentenceTransformer model to load.",
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="auto",
+        help="Torch device to run the model on ('auto' picks cuda when available, otherwise cpu).",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=0,
+        help="Number of intra-op CPU threads used by torch (0 keeps torch's default).",
+    )
+    parser.add_argument(
+        "--interop-threads",
+        type=int,
+        default=0,
+        help="Number of inter-op CPU threads used by torch (0 keeps torch's default).",
+    )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Apply dynamic int8 quantization to the model's linear layers (CPU only).",
+    )
+    parser.add_argument(
+        "--quantize-check-file",
+        type=str,
+        help="File with one sentence per line used to compare quantized and fp32 embeddings.",
+    )
+    parser.add_argument(
+        "--fake-model",
+        action="store_true",
+        help="Use a deterministic fake model instead of loading weights.",
+    )
+    parser.add_argument(
+        "--fake-dimensions",
+        type=int,
+        default=768,
+        help="Embedding dimensions produced by the fake model.",
+    )
+    args = parser.parse_args()
+
+    if args.encode_batch_size < 1:
+        parser.error("--encode-batch-size must be at least 1.")
+    if args.metrics_interval <= 0:
+        parser.error("--metrics-interval must be positive.")
+    bucketer = LengthBucketer(
+        args.encode_batch_size, args.max_seq_length, not args.no_length_buckets
+    )
+
+    if args.fake_model:
+        backend = FakeBackend(args.fake_dimensions, bucketer)
+    else:
+        check_sentences = None
+        if args.quantize_check_file:
+            with open(args.quantize_check_file, "r", encoding="utf-8") as f:
+                check_sentences = [line.strip() for line in f if line.strip()]
+        backend = SentenceTransformerBackend(
+            args.model,
+            args.device,
+            args.threads,
+            args.interop_threads,
+            args.quantize,
+            check_sentences,
+            bucketer,
+        )
+
+    exporters = start_metrics(
+        args.metrics_port, args.metrics_file, args.metrics_interval
+    )
+    if args.metrics_port > 0:
+        print(f"Serving metrics on port: {args.metrics_port}")
+    try:
+        if args.mode == "socket":
+            serve_socket(
+                backend,
+                args.socket_path,
+                args.max_batch_size,
+                args.max_wait_ms / 1000,
+                args.stats_interval,
+            )
+        else:
+            serve_fifo(
+                backend,
+                args.request_file,
+                args.reply_file,
+                args.reply_format,
+                args.reply_dtype,
+            )
+    finally:
+        stop_metrics(exporters)
@@ -1,273 +1,1105 @@
 from os.path import isfile
-import requests
 import argparse
 import logging
-from utils.logging_utils import ColouredLogger
+from utils.logging_utils import ColouredLogger, LogSampler
 from utils.signal_utils import GracefulKiller
-from io import BytesIO, BufferedReader, IOBase, TextIOWrapper
-import numpy as np
+from utils.solr_utils import Solr, BufferedUpdater
+from utils.checkpoint_utils import CheckpointTracker
+from utils.failure_utils import FailureLog
+from utils.vector_utils import DEFAULT_PRECISION, format_vectors
+from utils.index_utils import INDEX_DTYPES, VectorIndexWriter
+from utils.shard_utils import SHARD_DTYPES, ShardReader, ShardWriter
+from utils.chunk_utils import (
+    DEFAULT_FIELD_MAP,
+    POOLING_METHODS,
+    FieldMapping,
+    TextChunker,
+    pool_segments,
+)
+from utils.metrics_utils import SIZE_BUCKETS, registry, start_metrics, stop_metrics
+from utils.cache_utils import EmbeddingCache, text_fingerprint
+from utils.embedding_utils import (
+    DEFAULT_MODEL,
+    DEFAULT_SOCKET_PATH,
+    RAW_DTYPE_CODES,
+    EmbeddingClient,
+    create_embedding_client,
+)
+from datetime import datetime, timezone
+from functools import partial
+from typing import Callable, Iterator
+import asyncio
 import json
-import pickle
+import multiprocessing
 import os
+import time
+
+import numpy as np
+
+LAST_RUN_SUFFIX = "-last-run"
+FAILURE_LOG_SUFFIX = "-failures"
+IMPORT_FAILURE_LOG_SUFFIX = "-import-failures"
+IMPORT_STAGE = "import"
 
 logger: ColouredLogger = logging.getLogger(__name__)
 
+embed_seconds = registry.histogram(
+    "indexer_embed_seconds", "Latency of embedding requests sent by the indexer."
+)
+embed_batch_size = registry.histogram(
+    "indexer_embed_batch_size", "Text chunks sent per embedding request.", SIZE_BUCKETS
+)
+embedded_documents = registry.counter(
+    "indexer_embedded_documents_total", "Documents embedded by the indexer."
+)
+embed_failed_documents = registry.counter(
+    "indexer_embed_failed_documents_total", "Documents whose embedding request failed."
+)
+invalid_documents = registry.counter(
+    "indexer_invalid_documents_total", "Documents skipped for a missing or empty title."
+)
+unchanged_documents = registry.counter(
+    "indexer_unchanged_documents_total",
+    "Documents skipped in incremental mode because their title is unchanged.",
+)
+documents_per_second = registry.gauge(
+    "indexer_documents_per_second",
+    "Documents updated per second since the run started.",
+)
+fetched_queue_depth = registry.gauge(
+    "indexer_fetched_queue_depth",
+    "Batches waiting to be embedded in the async pipeline.",
+)
+embedded_queue_depth = registry.gauge(
+    "indexer_embedded_queue_depth",
+    "Batches waiting to be sent to Solr in the async pipeline.",
+)
 
-class Solr:
-    def __init__(
+
+class DocBatch:
+    """
+    The chunks of every mapped field of every document form one flat list, so
+    a batch needs a single embedding request. Each (document, field) segment
+    of that list starts at its entry in segment_starts.
+    """
+
+    def __init__(self) -> None:
+        self.doc_ids: list[str] = []
+        self.fingerprints: list[str] = []
+        self.chunks: list[str] = []
+        self.segment_starts: list[int] = []
+        self.segment_docs: list[int] = []
+        self.segment_mappings: list[FieldMapping] = []
+        self.final = False
+
+    def append(
         self,
-        host: str,
-        port: int,
-        collection: str,
-    ) -> None:
-        self._host = host
-        self._port = port
-        self._collection = collection
-        self._uri = f"http://{host}:{port}/solr/{collection}"
-
-    class _Cursor:
-        def __init__(self, uri, q, buffer_size, cursor, sort, total_scrolled) -> None:
-            self._uri = uri
-            self._doc_buffer = []
-            self._q = q
-            self._buffer_size = buffer_size
-            self._cursor = cursor
-            self._previous_cursor = cursor
-            self._sort = sort
-            self.total_scrolled = total_scrolled
-
-        def __iter__(self):
-            return self
-
-        def __next__(self) -> dict[str, object]:
-            self.total_scrolled += 1
-            if len(self._doc_buffer) != 0:
-                return self._doc_buffer.pop()
-
-            logger.debug(
-                f"Buffer ran out of documents. Requesting {self._buffer_size} more documents..."
+        doc_id: str,
+        texts: list[tuple[FieldMapping, str]],
+        fingerprint: str,
+        chunker: TextChunker,
+    ):
+        for mapping, text in texts:
+            self.segment_starts.append(len(self.chunks))
+            self.segment_docs.append(len(self.doc_ids))
+            self.segment_mappings.append(mapping)
+            self.chunks.extend(chunker.split(text))
+        self.doc_ids.append(doc_id)
+        self.fingerprints.append(fingerprint)
+
+    def pool(self, embeddings: np.ndarray) -> np.ndarray:
+        starts = np.asarray(self.segment_starts, dtype=np.intp)
+        methods = [mapping.pooling for mapping in self.segment_mappings]
+        pooled = None
+        for method in sorted(set(methods)):
+            rows = pool_segments(embeddings, starts, method)
+            if pooled is None:
+                pooled = rows
+            else:
+                selected = np.array([m == method for m in methods])
+                pooled[selected] = rows[selected]
+        return pooled
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+
+class RunStats:
+    def __init__(self) -> None:
+        self.failed_count = 0
+        self.embed_failed_count = 0
+        self.skipped_count = 0
+
+
+def valid_text(
+    doc: dict[str, object], doc_id: str, field: str, required: bool = True
+) -> str | None:
+    text = doc.get(field)
+    if isinstance(text, list) and all(isinstance(x, str) for x in text):
+        text = " ".join(text)
+    log = logger.warning if required else logger.debug
+    if text is None:
+        log(f"Could not find field '{field}' in doc with ID: '{doc_id}'")
+    elif not isinstance(text, str):
+        logger.error(f"Field '{field}' in doc with ID: '{doc_id}' is not a string.")
+    elif not text.strip():
+        log(f"Field '{field}' in doc with ID: '{doc_id}' is empty.")
+    else:
+        return text
+    return None
+
+
+def document_texts(
+    doc: dict[str, object],
+    doc_id: str,
+    mappings: list[FieldMapping],
+    stats: RunStats,
+) -> list[tuple[FieldMapping, str]] | None:
+    """
+    Returns the text of every mapped field the document has. The first mapping
+    is required, documents without it are counted as failed.
+    """
+    texts = []
+    for i, mapping in enumerate(mappings):
+        text = valid_text(doc, doc_id, mapping.source, required=i == 0)
+        if text is not None:
+            texts.append((mapping, text))
+        elif i == 0:
+            stats.failed_count += 1
+            invalid_documents.inc()
+            return None
+    return texts
+
+
+def texts_fingerprint(model_name: str, texts: list[tuple[FieldMapping, str]]) -> str:
+    # A lone field hashes exactly like the title fingerprints stored before
+    # fields could be mapped, so incremental runs keep skipping them.
+    return text_fingerprint(model_name, "\0".join(text for _, text in texts))
+
+
+def collect_batch(
+    cursor,
+    tracker: CheckpointTracker,
+    batch_size: int,
+    killer: GracefulKiller,
+    stats: RunStats,
+    model_name: str,
+    incremental: bool,
+    fingerprint_field: str,
+    mappings: list[FieldMapping],
+    chunker: TextChunker,
+    sampler: LogSampler,
+) -> DocBatch:
+    batch = DocBatch()
+    for doc in cursor:
+        doc_id = doc.get("id", "")
+        doc_position = cursor.total_scrolled
+        queued = False
+
+        if not isinstance(doc_id, str) or not doc_id:
+            logger.warning(
+                f"Document at position: {doc_position} does not have a doc ID. Skipping..."
             )
-            params = {
-                "q": self._q,
-                "rows": self._buffer_size,
-                "cursorMark": self._cursor,
-                "sort": self._sort,
-                "wt": "json",
-            }
-            response = requests.get(
-                f"{self._uri}/select",
-                params=params,
+            doc_id = None
+        else:
+            if sampler():
+                logger.info(f"{doc_position}.document ID: {doc_id}")
+
+            texts = document_texts(doc, doc_id, mappings, stats)
+            if texts is not None:
+                fingerprint = texts_fingerprint(model_name, texts)
+                if incremental and doc.get(fingerprint_field) == fingerprint:
+                    logger.debug(f"Texts of doc with ID: '{doc_id}' are unchanged.")
+                    stats.skipped_count += 1
+                    unchanged_documents.inc()
+                else:
+                    batch.append(doc_id, texts, fingerprint, chunker)
+                    queued = True
+
+        tracker.track(doc_id, finished=not queued)
+        if killer.kill_now:
+            batch.final = True
+            return batch
+        if len(batch) >= batch_size:
+            return batch
+
+    batch.final = True
+    return batch
+
+
+def collect_retry_batch(
+    docs: Iterator[dict[str, object]],
+    batch_size: int,
+    killer: GracefulKiller,
+    stats: RunStats,
+    failures: FailureLog,
+    model_name: str,
+    mappings: list[FieldMapping],
+    chunker: TextChunker,
+    sampler: LogSampler,
+) -> DocBatch:
+    batch = DocBatch()
+    for doc in docs:
+        doc_id = str(doc["id"])
+        if sampler():
+            logger.info(f"Retrying document ID: {doc_id}")
+        texts = document_texts(doc, doc_id, mappings, stats)
+        if texts is None:
+            failures.record(
+                [doc_id], "validate", f"Document has no usable {mappings[0].source}."
             )
-            if response.status_code != 200:
-                raise StopIteration()
-
-            result = response.json()
-
-            if result["nextCursorMark"] == self._cursor:
-                raise StopIteration()
-
-            self._previous_cursor = self._cursor
-            self._cursor = result["nextCursorMark"]
-            self._doc_buffer.extend(result["response"]["docs"])
-
-            return self._doc_buffer.pop()
-
-        def reset(self):
-            self._doc_buffer = []
-            self._cursor = "*"
-            self._previous_cursor = "*"
-            self.total_scrolled = 0
-
-        def save(self, f: TextIOWrapper):
-            data = {
-                "cursor": self._previous_cursor,
-                "buffer_remaining": len(self._doc_buffer),
-                "uri": self._uri,
-                "buffer_size": self._buffer_size,
-                "sort": self._sort,
-                "q": self._q,
-                "total_scrolled": self.total_scrolled,
-            }
-            json.dump(data, f, indent=4)
-
-    def atomic_update(self, doc_id: str, updates: dict[str, object]):
-        if not updates:
-            logger.warning(f"Recieved empty updates for document ID: '{doc_id}'")
-            return False
-        constructed_updates: dict[str, object] = {"id": doc_id}
-
-        for key, value in updates.items():
-            constructed_updates[key] = {"set": value}
-
-        payload = json.dumps([constructed_updates])
-
-        response = requests.post(
-            f"{self._uri}/update?commitWithin=1000",
-            data=payload,
-            headers={"Content-Type": "application/json"},
+        else:
+            batch.append(doc_id, texts, texts_fingerprint(model_name, texts), chunker)
+
+        if killer.kill_now:
+            batch.final = True
+            return batch
+        if len(batch) >= batch_size:
+            return batch
+
+    batch.final = True
+    return batch
+
+
+def lookup_failed_documents(
+    solr: Solr,
+    doc_ids: list[str],
+    lookup_batch_size: int,
+    fields: list[str],
+    killer: GracefulKiller,
+    failures: FailureLog,
+) -> Iterator[dict[str, object]]:
+    for i in range(0, len(doc_ids), lookup_batch_size):
+        if killer.kill_now:
+            return
+        chunk = doc_ids[i : i + lookup_batch_size]
+        docs = solr.get_documents(chunk, fields)
+        if docs is None:
+            failures.record(chunk, "lookup", "Solr lookup request failed.")
+            continue
+
+        found = {doc.get("id") for doc in docs}
+        missing = [doc_id for doc_id in chunk if doc_id not in found]
+        if missing:
+            logger.warning(f"Could not find {len(missing)} documents: {missing}")
+            failures.record(missing, "lookup", "Document not found.")
+        yield from docs
+
+
+def handle_flush(
+    failures: FailureLog,
+    tracker: CheckpointTracker | None,
+    doc_ids: list[str],
+    succeeded: bool,
+):
+    if succeeded:
+        failures.resolve(doc_ids)
+    else:
+        failures.record(doc_ids, "update", "Solr update request failed.")
+    if tracker is not None:
+        tracker.finish_ids(doc_ids)
+
+
+def handle_embed_failure(
+    doc_ids: list[str],
+    stats: RunStats,
+    failures: FailureLog,
+    tracker: CheckpointTracker | None,
+    error: str = "Embedding request failed.",
+):
+    stats.embed_failed_count += len(doc_ids)
+    embed_failed_documents.inc(len(doc_ids))
+    failures.record(doc_ids, "embed", error)
+    if tracker is not None:
+        tracker.finish_ids(doc_ids)
+
+
+def queue_updates(
+    updater: BufferedUpdater,
+    batch: DocBatch,
+    embeddings: np.ndarray,
+    stats: RunStats,
+    failures: FailureLog,
+    tracker: CheckpointTracker | None,
+    fingerprint_field: str | None = None,
+    vector_precision: int = DEFAULT_PRECISION,
+):
+    pooled = batch.pool(embeddings)
+    segment_docs = np.asarray(batch.segment_docs, dtype=np.intp)
+    # A document fails as a whole when any of its pooled vectors is not finite.
+    valid = np.ones(len(batch), dtype=bool)
+    valid[segment_docs[~np.isfinite(pooled).all(axis=1)]] = False
+    if not valid.all():
+        invalid_ids = [batch.doc_ids[i] for i in np.flatnonzero(~valid)]
+        logger.error(
+            f"Embeddings of {len(invalid_ids)} documents contain NaN or infinite values. Document IDs: {invalid_ids}"
+        )
+        handle_embed_failure(
+            invalid_ids,
+            stats,
+            failures,
+            tracker,
+            "Embedding contains NaN or infinite values.",
         )
-        if response.status_code != 200:
-            logger.error("Failed to send atomic update to solr.")
-            return False
-        return True
 
-    def cursor(
-        self, q="*:*", buffer_size=10, sort="id asc", cursorMark="*", total_scrolled=0
+    segments = valid[segment_docs]
+    vectors = format_vectors(pooled[segments], vector_precision)
+    updates: list[dict[str, object]] = [{} for _ in batch.doc_ids]
+    for doc, mapping, vector in zip(
+        segment_docs[segments],
+        [m for m, keep in zip(batch.segment_mappings, segments) if keep],
+        vectors,
     ):
-        return Solr._Cursor(self._uri, q, buffer_size, cursorMark, sort, total_scrolled)
-
-    def resumedCursor(self, f: TextIOWrapper):
-        data: dict[str, object] = json.load(f)
-        uri = str(data.get("uri", ""))
-        cursorMark = str(data.get("cursor", ""))
-        buffer_remaining = data.get("buffer_remaining", -1)
-        buffer_size = data.get("buffer_size", -1)
-        sort = str(data.get("sort", ""))
-        q = str(data.get("q", ""))
-        total_scrolled = data.get("total_scrolled", -1)
-
-        if (
-            not isinstance(buffer_remaining, int)
-            or not isinstance(buffer_size, int)
-            or not isinstance(total_scrolled, int)
-        ):
-            logger.warning("Malformed cursor checkpoint. Returning new cursor.")
-            return self.cursor()
-
-        if (
-            not uri
-            or not cursorMark
-            or buffer_remaining == -1
-            or buffer_size == -1
-            or total_scrolled == -1
-            or not sort
-            or not q
-        ):
-            logger.warning("Malformed cursor checkpoint. Returning new cursor.")
-            return self.cursor()
-
-        if uri != self._uri:
-            logger.warning("Invalid Solr Uri. Returning new cursor.")
-            return self.cursor()
-
-        cursor = self.cursor(q, buffer_size, sort, cursorMark, total_scrolled)
-        logger.debug("Created resumed cursor. Fast forwarding to resumed state...")
-        fast_forward = buffer_size - buffer_remaining
-        logger.info(f"Fast forwarding {fast_forward} documents...")
-        for doc in cursor:
-            logger.debug(f"Popped ID: '{doc['id']}'.")
-            if len(cursor._doc_buffer) == buffer_remaining:
+        updates[doc][mapping.target] = vector
+    for i, doc_id in enumerate(batch.doc_ids):
+        if not valid[i]:
+            continue
+        if fingerprint_field:
+            updates[i][fingerprint_field] = batch.fingerprints[i]
+        updater.add(doc_id, updates[i])
+
+
+def embed_batch(batch: DocBatch, embedder: EmbeddingClient) -> np.ndarray | None:
+    logger.debug(
+        f"Embedding batch of {len(batch.chunks)} chunks from {len(batch)} documents..."
+    )
+    embed_batch_size.observe(len(batch.chunks))
+    with embed_seconds.time():
+        embeddings = embedder.embed(batch.chunks)
+    if embeddings is not None:
+        embedded_documents.inc(len(batch))
+    else:
+        logger.error(
+            f"Could not generate embeddings for batch of {len(batch)} documents."
+        )
+    return embeddings
+
+
+def run_sync_pipeline(
+    collect: Callable[[], DocBatch],
+    updater: BufferedUpdater,
+    embedder: EmbeddingClient,
+    tracker: CheckpointTracker | None,
+    failures: FailureLog,
+    stats: RunStats,
+    fingerprint_field: str | None,
+    vector_precision: int,
+):
+    while True:
+        batch = collect()
+        if batch:
+            embeddings = embed_batch(batch, embedder)
+            if embeddings is None:
+                handle_embed_failure(batch.doc_ids, stats, failures, tracker)
+            else:
+                queue_updates(
+                    updater,
+                    batch,
+                    embeddings,
+                    stats,
+                    failures,
+                    tracker,
+                    fingerprint_field,
+                    vector_precision,
+                )
+        if batch.final:
+            return
+
+
+async def run_async_pipeline(
+    collect: Callable[[], DocBatch],
+    updater: BufferedUpdater,
+    embedder: EmbeddingClient,
+    tracker: CheckpointTracker | None,
+    failures: FailureLog,
+    stats: RunStats,
+    fingerprint_field: str | None,
+    vector_precision: int,
+    queue_size: int,
+):
+    fetched: asyncio.Queue[DocBatch | None] = asyncio.Queue(maxsize=queue_size)
+    embedded: asyncio.Queue[tuple[DocBatch, np.ndarray] | None] = asyncio.Queue(
+        maxsize=queue_size
+    )
+    fetched_queue_depth.set_function(fetched.qsize)
+    embedded_queue_depth.set_function(embedded.qsize)
+
+    # Sentinels are only sent when a stage finishes. When one raises, the
+    # others are cancelled instead, as they may be blocked on a full queue.
+    async def fetch_stage():
+        while True:
+            batch = await asyncio.to_thread(collect)
+            if batch:
+                await fetched.put(batch)
+            if batch.final:
                 break
-        cursor.total_scrolled = total_scrolled
+        await fetched.put(None)
 
-        return cursor
+    async def embed_stage():
+        while (batch := await fetched.get()) is not None:
+            embeddings = await asyncio.to_thread(embed_batch, batch, embedder)
+            if embeddings is None:
+                handle_embed_failure(batch.doc_ids, stats, failures, tracker)
+                continue
+            await embedded.put((batch, embeddings))
+        await embedded.put(None)
 
+    async def update_stage():
+        while (item := await embedded.get()) is not None:
+            batch, embeddings = item
+            await asyncio.to_thread(
+                queue_updates,
+                updater,
+                batch,
+                embeddings,
+                stats,
+                failures,
+                tracker,
+                fingerprint_field,
+                vector_precision,
+            )
+
+    stages = [
+        asyncio.create_task(fetch_stage()),
+        asyncio.create_task(embed_stage()),
+        asyncio.create_task(update_stage()),
+    ]
+    try:
+        await asyncio.gather(*stages)
+    finally:
+        for stage in stages:
+            stage.cancel()
+        await asyncio.gather(*stages, return_exceptions=True)
+        fetched_queue_depth.set_function(None)
+        embedded_queue_depth.set_function(None)
 
-def send_embedding_request(sentences: list[str], medium: IOBase):
-    if medium.readable():
-        logger.error("Medium must be write only..")
-        return False
-    if any([not x for x in sentences]):
-        logger.warning("Cannot embed empty text.")
-        return False
 
-    pickle.dump(sentences, medium)
-    return True
+def load_last_run(state_file: str) -> str | None:
+    if not os.path.isfile(state_file):
+        return None
+    with open(state_file, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    last_run = data.get("last_run")
+    if not isinstance(last_run, str) or not last_run:
+        logger.warning("Malformed last run state. Ignoring it.")
+        return None
+    return last_run
 
 
-def recieve_embeddings(recieve_file: BufferedReader) -> np.ndarray:
-    if recieve_file.writable():
-        logger.error("Recieve file must be read only.")
-        return np.ndarray((1,))
-    buffer = BytesIO(recieve_file.read())
-    buffer.seek(0)
-    return np.load(buffer)
+def save_last_run(state_file: str, last_run: str):
+    with open(state_file, "w", encoding="utf-8") as f:
+        json.dump({"last_run": last_run}, f, indent=4)
 
 
 def main(
     host: str,
     port: int,
     collection: str,
-    request_file: str,
-    recieve_file: str,
+    embedder: EmbeddingClient,
+    failures: FailureLog,
     checkpoint_suffix: str,
     resume_checkpoint: bool,
+    checkpoint_every: int,
+    checkpoint_seconds: float,
     query: str,
     sort: str,
     buffer_size: int,
+    embed_batch_size: int,
+    update_batch_size: int,
+    update_batch_bytes: int,
+    commit_within: int | None,
+    pool_size: int,
+    max_retries: int,
+    retry_backoff: float,
+    prefetch_pages: int,
+    model_name: str,
+    incremental: bool,
+    fingerprint_field: str,
+    field_mappings: list[FieldMapping],
+    chunker: TextChunker,
+    delta: bool,
+    modified_field: str,
+    stream_parse: bool,
+    vector_precision: int,
+    log_every: int,
+    log_interval: float,
+    pipeline: str,
+    pipeline_queue_size: int,
+    partition: tuple[int, int] | None = None,
+    partition_filters: list[str] | None = None,
 ):
     killer = GracefulKiller()
-    solr = Solr(host, port, collection)
+    solr = Solr(host, port, collection, pool_size, max_retries, retry_backoff)
+
+    filter_queries = []
+    if delta:
+        state_file = f".{collection}{LAST_RUN_SUFFIX}.json"
+        last_run = load_last_run(state_file)
+        if last_run is None:
+            logger.warning(
+                "No previous successful run recorded. Selecting all documents..."
+            )
+        else:
+            logger.info(f"Selecting documents modified since {last_run}...")
+            filter_queries.append(f"{modified_field}:[{last_run} TO *]")
+
+    if partition is not None:
+        worker, workers = partition
+        if partition_filters:
+            filter_queries.append(partition_filters[worker])
+        else:
+            filter_queries.append(
+                f"{{!hash workers={workers} worker={worker} partitionKeys=id}}"
+            )
+        logger.info(f"Indexing partition {worker + 1} of {workers}...")
 
-    checkpoint_file = f".{collection}{checkpoint_suffix}.json"
+    fields = ["id"] + [mapping.source for mapping in field_mappings]
+    if incremental:
+        fields.append(fingerprint_field)
+
+    checkpoint_file = checkpoint_path(collection, checkpoint_suffix, partition)
     if resume_checkpoint:
         if not os.path.isfile(checkpoint_file):
             logger.warning("Checkpoint file doesn't exist. Returning new cursor...")
-            cursor = solr.cursor(query, buffer_size, sort)
+            cursor = solr.cursor(
+                query,
+                buffer_size,
+                sort,
+                prefetch_pages=prefetch_pages,
+                fq=filter_queries,
+                fl=fields,
+                stream_parse=stream_parse,
+            )
         else:
             logger.info("Opening checkpoint file...")
             with open(checkpoint_file, "r", encoding="utf-8") as f:
-                cursor = solr.resumedCursor(f)
+                cursor = solr.resumedCursor(f, prefetch_pages)
     else:
         logger.debug("No checkpoint selected.")
-        cursor = solr.cursor(query, buffer_size, sort)
+        cursor = solr.cursor(
+            query,
+            buffer_size,
+            sort,
+            prefetch_pages=prefetch_pages,
+            fq=filter_queries,
+            fl=fields,
+            stream_parse=stream_parse,
+        )
 
-    updated_count = 0
-    failed_count = 0
-    for doc in cursor:
-        doc_id = doc.get("id", "")
-        doc_position = cursor.total_scrolled
+    tracker = CheckpointTracker(
+        cursor, checkpoint_file, checkpoint_every, checkpoint_seconds
+    )
+    updater = BufferedUpdater(
+        solr,
+        update_batch_size,
+        update_batch_bytes,
+        commit_within,
+        on_flush=partial(handle_flush, failures, tracker),
+    )
+    started = time.perf_counter()
+    documents_per_second.set_function(
+        lambda: updater.updated_count / (time.perf_counter() - started)
+    )
 
-        if not isinstance(doc_id, str) or not doc_id:
-            logger.warning(
-                f"Document at position: {doc_position} does not have a doc ID. Skipping..."
+    stats = RunStats()
+    collect = partial(
+        collect_batch,
+        cursor,
+        tracker,
+        embed_batch_size,
+        killer,
+        stats,
+        model_name,
+        incremental,
+        fingerprint_field,
+        field_mappings,
+        chunker,
+        LogSampler(log_every, log_interval),
+    )
+    # Saved however the run ends, so an aborted run resumes right after the
+    # last document that was fully processed.
+    completed = False
+    try:
+        if pipeline == "async":
+            asyncio.run(
+                run_async_pipeline(
+                    collect,
+                    updater,
+                    embedder,
+                    tracker,
+                    failures,
+                    stats,
+                    fingerprint_field if incremental else None,
+                    vector_precision,
+                    pipeline_queue_size,
+                )
+            )
+        else:
+            run_sync_pipeline(
+                collect,
+                updater,
+                embedder,
+                tracker,
+                failures,
+                stats,
+                fingerprint_field if incremental else None,
+                vector_precision,
             )
-            continue
 
-        logger.info(f"{doc_position}.document ID: {doc_id}")
+        committed = updater.close()
+        completed = True
+    finally:
+        cursor.close()
+        if killer.kill_now:
+            logger.info("Recieved shutdown signal. Exitting gracefully...")
+            tracker.save()
+        elif cursor.failed:
+            logger.warning("Traversal stopped early. Saving checkpoint...")
+            tracker.save()
+        elif not completed:
+            logger.error("Indexing aborted. Saving checkpoint...")
+            tracker.save()
+        elif os.path.isfile(checkpoint_file):
+            logger.info("Traversal finished. Removing checkpoint...")
+            os.remove(checkpoint_file)
+        solr.close()
 
-        title = doc.get("original_dc_title")
-        if title is None:
-            logger.warning(f"Could not find original title in doc with ID: '{doc_id}'")
-            failed_count += 1
-            continue
+    if incremental:
+        logger.info(f"Total skipped as unchanged: {stats.skipped_count}")
 
-        if not isinstance(title, str):
-            logger.error(
-                f"Original title field in doc with ID: '{doc_id}' is not a string."
-            )
-            failed_count += 1
-            continue
-        with open(request_file, "wb") as fs:
-            if not send_embedding_request([title], fs):
-                logger.error(
-                    f"Could not send embedding request for doc with ID: '{doc_id}'"
-                )
-                failed_count += 1
-                continue
-        with open(recieve_file, "rb") as fd:
-            embeddings = recieve_embeddings(fd)
-            logger.debug(
-                f"Generated embeddings length for Doc with ID: '{doc_id}': {len(embeddings)}"
-            )
+    return (
+        updater.updated_count,
+        stats.failed_count + stats.embed_failed_count + updater.failed_count,
+        not killer.kill_now
+        and not cursor.failed
+        and committed
+        and stats.embed_failed_count + updater.failed_count == 0,
+    )
 
-        updates = {}
-        updates["title_bert_vector"] = [float(w) for w in embeddings[0]]
 
-        if not solr.atomic_update(doc_id, updates):
-            logger.warning(f"Failed to update doc with ID: '{doc_id}'")
-            failed_count += 1
-            continue
-        logger.info(f"Succesfully updated doc with ID: '{doc_id}'")
-        updated_count += 1
+def checkpoint_path(
+    collection: str, checkpoint_suffix: str, partition: tuple[int, int] | None = None
+) -> str:
+    if partition is None:
+        return f".{collection}{checkpoint_suffix}.json"
+    worker, workers = partition
+    return f".{collection}-w{worker + 1}of{workers}{checkpoint_suffix}.json"
+
+
+def failure_log_path(args: argparse.Namespace, suffix: str = FAILURE_LOG_SUFFIX) -> str:
+    return args.failure_log or f".{args.collection}{suffix}.jsonl"
+
+
+def register_cache_metrics(cache: EmbeddingCache):
+    for key in ("hits", "disk_hits", "misses", "size"):
+        registry.gauge(
+            f"embedding_cache_{key}", f"Embedding cache {key.replace('_', ' ')}."
+        ).set_function(lambda key=key: cache.stats()[key])
+
+    def hit_ratio() -> float:
+        stats = cache.stats()
+        lookups = stats["hits"] + stats["disk_hits"] + stats["misses"]
+        return (stats["hits"] + stats["disk_hits"]) / lookups if lookups else 0
+
+    registry.gauge(
+        "embedding_cache_hit_ratio", "Share of titles served from the embedding cache."
+    ).set_function(hit_ratio)
+
+
+def start_run_metrics(
+    args: argparse.Namespace, partition: tuple[int, int] | None = None
+) -> list:
+    port, snapshot_path = args.metrics_port, args.metrics_file
+    if partition is not None:
+        worker = partition[0]
+        port = port + worker if port > 0 else 0
+        if snapshot_path:
+            root, extension = os.path.splitext(snapshot_path)
+            snapshot_path = f"{root}-w{worker + 1}{extension}"
+    return start_metrics(port, snapshot_path, args.metrics_interval)
+
+
+def create_chunker(args: argparse.Namespace) -> TextChunker:
+    return TextChunker(args.chunk_words, args.chunk_overlap, args.max_chunks)
+
 
+def parse_field_mappings(
+    parser: argparse.ArgumentParser, args: argparse.Namespace
+) -> list[FieldMapping]:
+    try:
+        mappings = [FieldMapping.parse(spec) for spec in args.field_map]
+    except ValueError as e:
+        parser.error(str(e))
+    targets = [mapping.target for mapping in mappings]
+    if len(set(targets)) != len(targets):
+        parser.error("Every --field-map must write to a different vector field.")
+    if args.chunk_words < 1:
+        parser.error("--chunk-words must be at least 1.")
+    if not 0 <= args.chunk_overlap < args.chunk_words:
+        parser.error("--chunk-overlap must be between 0 and --chunk-words.")
+    return mappings
+
+
+def create_embedder(
+    args: argparse.Namespace,
+) -> tuple[EmbeddingClient, EmbeddingCache | None]:
+    cache = None
+    if args.cache_size > 0 or args.cache_file:
+        cache = EmbeddingCache(args.model_name, args.cache_size, args.cache_file)
+        register_cache_metrics(cache)
+    embedder = create_embedding_client(
+        args.socket_path,
+        args.request_file,
+        args.recieve_file,
+        reply_dtype=args.embedding_dtype,
+        cache=cache,
+    )
+    return (embedder, cache)
+
+
+def run_indexer(
+    args: argparse.Namespace, partition: tuple[int, int] | None = None
+) -> tuple[int, int, bool]:
+    exporters = start_run_metrics(args, partition)
+    embedder, cache = create_embedder(args)
+    counts = main(
+        args.host,
+        args.port,
+        args.collection,
+        embedder,
+        FailureLog(failure_log_path(args)),
+        args.checkpoint_suffix,
+        args.resume_checkpoint,
+        args.checkpoint_every,
+        args.checkpoint_seconds,
+        args.query,
+        args.sort,
+        args.buffer_size,
+        args.embed_batch_size,
+        args.update_batch_size,
+        args.update_batch_bytes,
+        None if args.defer_commit else args.commit_within,
+        args.pool_size,
+        args.max_retries,
+        args.retry_backoff,
+        args.prefetch_pages,
+        args.model_name,
+        args.incremental,
+        args.fingerprint_field,
+        args.field_mappings,
+        create_chunker(args),
+        args.delta,
+        args.modified_field,
+        args.stream_parse,
+        args.vector_precision,
+        args.log_every,
+        args.log_interval,
+        args.pipeline,
+        args.pipeline_queue_size,
+        partition,
+        args.partition_fq,
+    )
+
+    if cache is not None:
+        logger.info(f"Embedding cache stats: {cache.stats()}")
+    embedder.close()
+    stop_metrics(exporters)
+    return counts
+
+
+def iter_stored_vectors(
+    cursor: Iterator[dict[str, object]],
+    vector_field: str,
+    batch_size: int,
+    killer: GracefulKiller,
+    stats: RunStats,
+) -> Iterator[tuple[list[str], np.ndarray]]:
+    ids: list[str] = []
+    vectors: list[list[float]] = []
+    for doc in cursor:
+        doc_id = doc.get("id")
+        vector = doc.get(vector_field)
+        if not isinstance(doc_id, str) or not isinstance(vector, list) or not vector:
+            logger.debug(f"Document {doc_id} has no vector.")
+            stats.skipped_count += 1
+        else:
+            ids.append(doc_id)
+            vectors.append(vector)
+        if len(ids) >= batch_size:
+            yield (ids, np.array(vectors, dtype=np.float32))
+            ids, vectors = [], []
         if killer.kill_now:
-            logger.info("Recieved shutdown signal. Exitting gracefully...")
-            with open(checkpoint_file, "w", encoding="utf-8") as f:
-                cursor.save(f)
-            return (updated_count, failed_count)
+            return
+    if ids:
+        yield (ids, np.array(vectors, dtype=np.float32))
+
+
+def stored_vector_cursor(args: argparse.Namespace) -> tuple[Solr, Solr._Cursor]:
+    solr = Solr(
+        args.host,
+        args.port,
+        args.collection,
+        args.pool_size,
+        args.max_retries,
+        args.retry_backoff,
+    )
+    cursor = solr.cursor(
+        args.query,
+        args.buffer_size,
+        args.sort,
+        prefetch_pages=args.prefetch_pages,
+        fl=["id", args.vector_field],
+    )
+    return (solr, cursor)
+
+
+def build_vector_index(args: argparse.Namespace) -> int:
+    killer = GracefulKiller()
+    solr, cursor = stored_vector_cursor(args)
+    writer = VectorIndexWriter(args.output, args.index_dtype)
+    stats = RunStats()
+    for ids, vectors in iter_stored_vectors(
+        cursor, args.vector_field, args.buffer_size, killer, stats
+    ):
+        writer.add(ids, vectors)
+        logger.info(f"Indexed {cursor.total_scrolled - stats.skipped_count} vectors...")
+
+    cursor.close()
+    solr.close()
+    if killer.kill_now or cursor.failed:
+        logger.error("Index build did not finish. The index has no manifest.")
+        return 0
+
+    manifest = writer.close(args.nlist, args.kmeans_iterations, args.sample_size)
+    logger.info(
+        f"Built index of {manifest['count']} vectors with {manifest['nlist']} IVF lists in '{args.output}'. Documents without a vector: {stats.skipped_count}"
+    )
+    return int(manifest["count"])
+
+
+def export_vectors(args: argparse.Namespace) -> int:
+    killer = GracefulKiller()
+    solr, cursor = stored_vector_cursor(args)
+    writer = ShardWriter(
+        args.output, args.vector_field, args.shard_size, args.export_dtype
+    )
+    stats = RunStats()
+    for ids, vectors in iter_stored_vectors(
+        cursor, args.vector_field, args.buffer_size, killer, stats
+    ):
+        writer.add(ids, vectors)
+        logger.info(
+            f"Exported {cursor.total_scrolled - stats.skipped_count} vectors..."
+        )
+
+    cursor.close()
+    solr.close()
+    if killer.kill_now or cursor.failed:
+        logger.error("Export did not finish. The export has no manifest.")
+        return 0
+
+    manifest = writer.close(
+        {"collection": args.collection, "query": args.query, "sort": args.sort}
+    )
+    logger.info(
+        f"Exported {manifest['count']} vectors in {len(manifest['shards'])} shards to '{args.output}'. Documents without a vector: {stats.skipped_count}"
+    )
+    return int(manifest["count"])
+
+
+class ImportProgress:
+    """
+    Tracks how many exported vectors are confirmed in Solr without a gap
+    before them, which is where an interrupted import can continue.
+    """
+
+    def __init__(self, failures: FailureLog, skip: int) -> None:
+        self.failures = failures
+        self.confirmed = skip
+        self.has_gap = False
+
+    def handle_flush(self, doc_ids: list[str], succeeded: bool):
+        if succeeded:
+            self.failures.resolve(doc_ids)
+            if not self.has_gap:
+                self.confirmed += len(doc_ids)
+        else:
+            self.failures.record(doc_ids, IMPORT_STAGE, "Solr update request failed.")
+            self.has_gap = True
+
+
+def import_vectors(args: argparse.Namespace) -> tuple[int, int, bool]:
+    killer = GracefulKiller()
+    reader = ShardReader(args.input)
+    vector_field = args.vector_field or reader.vector_field
+    logger.info(
+        f"Importing {len(reader) - args.skip} vectors from '{args.input}' into field '{vector_field}'..."
+    )
+    progress = ImportProgress(
+        FailureLog(failure_log_path(args, IMPORT_FAILURE_LOG_SUFFIX)), args.skip
+    )
+    solr = Solr(
+        args.host,
+        args.port,
+        args.collection,
+        args.pool_size,
+        args.max_retries,
+        args.retry_backoff,
+    )
+    updater = BufferedUpdater(
+        solr,
+        args.update_batch_size,
+        args.update_batch_bytes,
+        None if args.defer_commit else args.commit_within,
+        on_flush=progress.handle_flush,
+    )
+
+    queued = args.skip
+    for ids, vectors in reader.batches(args.update_batch_size, args.skip):
+        for doc_id, vector in zip(ids, format_vectors(vectors, args.vector_precision)):
+            updater.add(doc_id, {vector_field: vector})
+        queued += len(ids)
+        logger.info(
+            f"Queued {queued} of {len(reader)} vectors, {progress.confirmed} confirmed..."
+        )
+        if killer.kill_now:
+            break
+
+    committed = updater.close()
+    solr.close()
+    if killer.kill_now or progress.has_gap:
+        logger.warning(
+            f"Import interrupted or had failures. Continue it with --skip {progress.confirmed}."
+        )
+    return (
+        updater.updated_count,
+        updater.failed_count,
+        not killer.kill_now and committed and updater.failed_count == 0,
+    )
 
-    return (updated_count, failed_count)
+
+def retry_failed(args: argparse.Namespace) -> tuple[int, int, bool]:
+    killer = GracefulKiller()
+    failures = FailureLog(failure_log_path(args))
+    doc_ids = failures.pending_ids(args.max_attempts)
+    exhausted = len(failures.pending) - len(doc_ids)
+    if exhausted:
+        logger.warning(
+            f"Skipping {exhausted} documents that already failed {args.max_attempts} times."
+        )
+
+    # Re-embedding would write the mapped fields, not the imported vector field.
+    imported = [
+        doc_id
+        for doc_id in doc_ids
+        if failures.pending[doc_id]["stage"] == IMPORT_STAGE
+    ]
+    if imported:
+        logger.warning(
+            f"Skipping {len(imported)} documents that failed to import. Continue the import with --skip instead."
+        )
+        doc_ids = [
+            doc_id
+            for doc_id in doc_ids
+            if failures.pending[doc_id]["stage"] != IMPORT_STAGE
+        ]
+
+    unsupported = [doc_id for doc_id in doc_ids if "," in doc_id]
+    if unsupported:
+        logger.warning(
+            f"Skipping {len(unsupported)} document IDs containing commas, which terms lookups cannot express: {unsupported}"
+        )
+        doc_ids = [doc_id for doc_id in doc_ids if "," not in doc_id]
+    if not doc_ids:
+        logger.info("No failed documents to retry.")
+        return (0, 0, True)
+    logger.info(f"Retrying {len(doc_ids)} failed documents...")
+
+    exporters = start_run_metrics(args)
+    embedder, cache = create_embedder(args)
+    solr = Solr(
+        args.host,
+        args.port,
+        args.collection,
+        args.pool_size,
+        args.max_retries,
+        args.retry_backoff,
+    )
+    updater = BufferedUpdater(
+        solr,
+        args.update_batch_size,
+        args.update_batch_bytes,
+        None if args.defer_commit else args.commit_within,
+        on_flush=partial(handle_flush, failures, None),
+    )
+    stats = RunStats()
+    docs = lookup_failed_documents(
+        solr,
+        doc_ids,
+        args.lookup_batch_size,
+        ["id"] + [mapping.source for mapping in args.field_mappings],
+        killer,
+        failures,
+    )
+    collect = partial(
+        collect_retry_batch,
+        docs,
+        args.embed_batch_size,
+        killer,
+        stats,
+        failures,
+        args.model_name,
+        args.field_mappings,
+        create_chunker(args),
+        LogSampler(args.log_every, args.log_interval),
+    )
+    run_sync_pipeline(
+        collect,
+        updater,
+        embedder,
+        None,
+        failures,
+        stats,
+        args.fingerprint_field if args.incremental else None,
+        args.vector_precision,
+    )
+
+    committed = updater.close()
+    solr.close()
+    if cache is not None:
+        logger.info(f"Embedding cache stats: {cache.stats()}")
+    embedder.close()
+    stop_metrics(exporters)
+
+    still_failing = [doc_id for doc_id in doc_ids if doc_id in failures.pending]
+    return (
+        updater.updated_count,
+        len(still_failing),
+        not killer.kill_now and committed and not still_failing,
+    )
+
+
+def run_partitioned(args: argparse.Namespace) -> tuple[int, int, bool]:
+    GracefulKiller()
+    workers = args.workers
+    partitions = [(args, (worker, workers)) for worker in range(workers)]
+    logger.info(f"Starting {workers} indexing workers...")
+    with multiprocessing.Pool(workers) as pool:
+        results = pool.starmap(run_indexer, partitions)
+        # Leaving the block terminates the pool, which would send finished
+        # workers a shutdown signal. Joining first lets them exit normally.
+        pool.close()
+        pool.join()
+
+    for worker, counts in enumerate(results):
+        logger.info(
+            f"Partition {worker + 1} of {workers}. Updated: {counts[0]}. Failed: {counts[1]}"
+        )
+    return (
+        sum(counts[0] for counts in results),
+        sum(counts[1] for counts in results),
+        all(counts[2] for counts in results),
+    )
 
 
 def print_saved_checkpoints(args: argparse.Namespace):
@@ -301,78 +1133,346 @@ def remove_saved_checkpoint(args: argparse.Namespace):
         print(f"{checkpoint_name} deleted succesfully.")
 
 
-if __name__ == "__main__":
-    LOGGING_FOLDER = "./logs"
-    LOGGING_FILE = f"{LOGGING_FOLDER}/vector-populator.log"
-    CHECKPOINT_SUFFIX = "-checkpoint"
-
-    parent_parser = argparse.ArgumentParser(
-        "Solr Vector Indexer",
-        allow_abbrev=False,
+def add_solr_arguments(parser: argparse.ArgumentParser) -> argparse._ArgumentGroup:
+    parser.add_argument(
+        "-d",
+        "--debug",
+        default=False,
+        action="store_true",
+        help="Enable debug mode.",
+    )
+    parser.add_argument(
+        "-al",
+        "--async-logging",
+        action="store_true",
+        help="Hand log records to a background thread instead of writing them on the indexing thread.",
     )
 
-    subparsers = parent_parser.add_subparsers()
+    solr_args = parser.add_argument_group("Solr Args")
 
-    checkpoints = subparsers.add_parser(
-        "checkpoints", help="Checkpoint Operations.", allow_abbrev=False
+    solr_args.add_argument(
+        "-t",
+        "--host",
+        default="localhost",
+        type=str,
+        help="Host of target Solr instance.",
     )
-    checkpoint_commands = checkpoints.add_subparsers()
-    list_checkpoints = checkpoint_commands.add_parser(
-        "ls", help="List saved checkpoints."
+    solr_args.add_argument(
+        "-p", "--port", default=8983, type=int, help="Port of target Solr instance."
     )
-
-    remove_checkpoint = checkpoint_commands.add_parser(
-        "rm", help="Delete a checkpoint by number."
+    solr_args.add_argument(
+        "-c",
+        "--collection",
+        type=str,
+        required=True,
+        help="Name of target Solr collection.",
     )
-    remove_checkpoint.add_argument("checkpoint_number", type=int)
+    solr_args.add_argument(
+        "-ps",
+        "--pool-size",
+        type=int,
+        default=10,
+        help="Number of persistent HTTP connections kept open to Solr.",
+    )
+    solr_args.add_argument(
+        "-mr",
+        "--max-retries",
+        type=int,
+        default=3,
+        help="Number of retries for failed Solr requests (5xx or connection errors).",
+    )
+    solr_args.add_argument(
+        "-rb",
+        "--retry-backoff",
+        type=float,
+        default=0.5,
+        help="Exponential backoff factor in seconds between Solr request retries.",
+    )
+    return solr_args
 
-    parser = subparsers.add_parser(
-        "run",
-        help="Start vector indexing.",
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+
+def add_stored_vector_arguments(
+    parser: argparse.ArgumentParser, title: str, output_help: str
+) -> argparse._ArgumentGroup:
+    add_solr_arguments(parser)
+    vector_args = parser.add_argument_group(title)
+
+    vector_args.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        required=True,
+        help=output_help,
+    )
+    vector_args.add_argument(
+        "-q",
+        "--query",
+        type=str,
+        default="*:*",
+        help="Query selecting the documents whose vectors are read.",
+    )
+    vector_args.add_argument(
+        "-sr",
+        "--sort",
+        type=str,
+        default="id asc",
+        help="Sort criteria for traversing documents (must include a unique field).",
+    )
+    vector_args.add_argument(
+        "-bs",
+        "--buffer-size",
+        type=int,
+        default=500,
+        help="Number of documents fetched per Solr page and written per batch.",
+    )
+    vector_args.add_argument(
+        "-pp",
+        "--prefetch-pages",
+        type=int,
+        default=1,
+        help="Number of Solr pages to fetch ahead on a background thread.",
+    )
+    vector_args.add_argument(
+        "-vf",
+        "--vector-field",
+        type=str,
+        default="title_bert_vector",
+        help="Solr field holding the stored document vectors.",
     )
+    return vector_args
 
+
+def add_indexer_arguments(
+    parser: argparse.ArgumentParser,
+) -> tuple[argparse._ArgumentGroup, argparse._ArgumentGroup]:
     parser.add_argument(
         "-r",
         "--request-file",
-        required=True,
         type=str,
         help="Path to file used for sending the embeddings request.",
     )
     parser.add_argument(
         "-s",
         "--recieve-file",
-        required=True,
         type=str,
         help="Path to file used for recieving the embedding result.",
     )
     parser.add_argument(
-        "-d",
-        "--debug",
-        default=False,
-        action="store_true",
-        help="Enable debug mode.",
+        "-u",
+        "--socket-path",
+        type=str,
+        help=f"Unix domain socket of an embedding server started with 'bert.py --mode socket' (e.g. {DEFAULT_SOCKET_PATH}). Takes precedence over the request and recieve files.",
     )
-
-    solr_args = parser.add_argument_group("Solr Args")
+    solr_args = add_solr_arguments(parser)
 
     solr_args.add_argument(
-        "-t",
-        "--host",
-        default="localhost",
+        "-fm",
+        "--field-map",
         type=str,
-        help="Host of target Solr instance.",
+        nargs="+",
+        default=[DEFAULT_FIELD_MAP],
+        help=f"Text fields to embed as SOURCE:TARGET[:{'|'.join(POOLING_METHODS)}]. The first source is required, documents missing the others just skip them.",
     )
     solr_args.add_argument(
-        "-p", "--port", default=8983, type=int, help="Port of target Solr instance."
+        "-i",
+        "--incremental",
+        action="store_true",
+        help="Store a fingerprint of the mapped texts next to the vectors and skip documents whose fingerprint is unchanged.",
     )
     solr_args.add_argument(
-        "-c",
-        "--collection",
+        "-ff",
+        "--fingerprint-field",
         type=str,
-        required=True,
-        help="Name of target Solr collection.",
+        default="title_bert_fingerprint",
+        help="Solr string field holding the title fingerprint in incremental mode.",
+    )
+
+    developer_args = parser.add_argument_group(
+        "Developer Args", "Used for tweaking program's performance."
+    )
+
+    developer_args.add_argument(
+        "-ebs",
+        "--embed-batch-size",
+        type=int,
+        default=1,
+        help="Number of titles to embed per request to the embedding model.",
+    )
+    developer_args.add_argument(
+        "-ed",
+        "--embedding-dtype",
+        choices=tuple(RAW_DTYPE_CODES),
+        default="float32",
+        help="Float precision of embeddings sent back by a socket embedding server.",
+    )
+    developer_args.add_argument(
+        "-vp",
+        "--vector-precision",
+        type=int,
+        default=DEFAULT_PRECISION,
+        help="Significant digits written per vector component (9 round-trips float32 exactly).",
+    )
+    developer_args.add_argument(
+        "-ubs",
+        "--update-batch-size",
+        type=int,
+        default=1,
+        help="Maximum number of documents sent to Solr per update request.",
+    )
+    developer_args.add_argument(
+        "-ubb",
+        "--update-batch-bytes",
+        type=int,
+        default=5_000_000,
+        help="Maximum payload size in bytes of a single Solr update request.",
+    )
+    developer_args.add_argument(
+        "-cw",
+        "--commit-within",
+        type=int,
+        default=1000,
+        help="Milliseconds within which Solr should commit each update batch.",
+    )
+    developer_args.add_argument(
+        "-dc",
+        "--defer-commit",
+        action="store_true",
+        help="Skip commitWithin on update batches and send a single commit when indexing ends.",
+    )
+
+    chunk_args = parser.add_argument_group(
+        "Chunking Args",
+        "Split long texts into overlapping word windows whose vectors are pooled per field.",
+    )
+
+    chunk_args.add_argument(
+        "-chw",
+        "--chunk-words",
+        type=int,
+        default=100,
+        help="Maximum number of words embedded per chunk. Keep it below the model's maximum sequence length.",
+    )
+    chunk_args.add_argument(
+        "-cho",
+        "--chunk-overlap",
+        type=int,
+        default=20,
+        help="Number of words shared by consecutive chunks.",
+    )
+    chunk_args.add_argument(
+        "-mch",
+        "--max-chunks",
+        type=int,
+        default=0,
+        help="Maximum number of chunks embedded per field, dropping the rest of the text (0 keeps all).",
+    )
+
+    cache_args = parser.add_argument_group(
+        "Cache Args", "Reuse embeddings of previously seen titles."
+    )
+
+    cache_args.add_argument(
+        "-cs",
+        "--cache-size",
+        type=int,
+        default=0,
+        help="Number of embeddings kept in the in-memory LRU cache (0 disables caching unless a cache file is given).",
+    )
+    cache_args.add_argument(
+        "-cf",
+        "--cache-file",
+        type=str,
+        help="Path of an sqlite database used to persist cached embeddings between runs.",
+    )
+    cache_args.add_argument(
+        "-mn",
+        "--model-name",
+        type=str,
+        default=DEFAULT_MODEL,
+        help="Name of the model served by the embedding server, used to namespace cached embeddings.",
     )
+    solr_args.add_argument(
+        "-fl",
+        "--failure-log",
+        type=str,
+        help=f"Append-only JSONL log of documents that failed to embed or update (defaults to .<collection>{FAILURE_LOG_SUFFIX}.jsonl).",
+    )
+
+    developer_args.add_argument(
+        "-le",
+        "--log-every",
+        type=int,
+        default=100,
+        help="Log only every n-th processed document ID (1 logs all of them).",
+    )
+    developer_args.add_argument(
+        "-li",
+        "--log-interval",
+        type=float,
+        default=0,
+        help="Also log a document ID whenever this many seconds passed since the last one (0 disables it).",
+    )
+
+    metrics_args = parser.add_argument_group(
+        "Metrics Args", "Expose per-stage latencies, throughput and queue depths."
+    )
+
+    metrics_args.add_argument(
+        "-mp",
+        "--metrics-port",
+        type=int,
+        default=0,
+        help="Port serving Prometheus metrics at /metrics (0 disables it). Worker processes use consecutive ports.",
+    )
+    metrics_args.add_argument(
+        "-msf",
+        "--metrics-file",
+        type=str,
+        help="Path of a JSON metrics snapshot rewritten periodically. Worker processes get a -w<n> suffix.",
+    )
+    metrics_args.add_argument(
+        "-msi",
+        "--metrics-interval",
+        type=float,
+        default=10,
+        help="Seconds between JSON metrics snapshots.",
+    )
+    return (solr_args, developer_args)
+
+
+if __name__ == "__main__":
+    LOGGING_FOLDER = "./logs"
+    LOGGING_FILE = f"{LOGGING_FOLDER}/vector-populator.log"
+    CHECKPOINT_SUFFIX = "-checkpoint"
+
+    parent_parser = argparse.ArgumentParser(
+        "Solr Vector Indexer",
+        allow_abbrev=False,
+    )
+
+    subparsers = parent_parser.add_subparsers()
+
+    checkpoints = subparsers.add_parser(
+        "checkpoints", help="Checkpoint Operations.", allow_abbrev=False
+    )
+    checkpoint_commands = checkpoints.add_subparsers()
+    list_checkpoints = checkpoint_commands.add_parser(
+        "ls", help="List saved checkpoints."
+    )
+
+    remove_checkpoint = checkpoint_commands.add_parser(
+        "rm", help="Delete a checkpoint by number."
+    )
+    remove_checkpoint.add_argument("checkpoint_number", type=int)
+
+    parser = subparsers.add_parser(
+        "run",
+        help="Start vector indexing.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    solr_args, developer_args = add_indexer_arguments(parser)
+
     solr_args.add_argument(
         "-q",
         "--query",
@@ -387,17 +1487,39 @@ if __name__ == "__main__":
         default="Sort criterial for fetching documents (Must include a unique field).",
         help="Query to select solr documents.",
     )
+    solr_args.add_argument(
+        "-dl",
+        "--delta",
+        action="store_true",
+        help="Only select documents modified since the last successful run.",
+    )
+    solr_args.add_argument(
+        "-mf",
+        "--modified-field",
+        type=str,
+        default="timestamp",
+        help="Solr date field holding the last modification time of a document.",
+    )
     solr_args.add_argument(
         "-rc",
         "--resume-checkpoint",
         action="store_true",
         help="Resume from previously saved checkpoint.",
     )
-
-    developer_args = parser.add_argument_group(
-        "Developer Args", "Used for tweaking program's performance."
+    solr_args.add_argument(
+        "-ce",
+        "--checkpoint-every",
+        type=int,
+        default=1000,
+        help="Save a checkpoint whenever this many more documents are fully processed (0 disables it).",
+    )
+    solr_args.add_argument(
+        "-ct",
+        "--checkpoint-seconds",
+        type=float,
+        default=60,
+        help="Save a checkpoint at most this many seconds after the previous one (0 disables it).",
     )
-
     developer_args.add_argument(
         "-bs",
         "--buffer-size",
@@ -405,6 +1527,199 @@ if __name__ == "__main__":
         default=10,
         help="Number of documents to cache while traversing Solr.",
     )
+    developer_args.add_argument(
+        "-pl",
+        "--pipeline",
+        choices=("sync", "async"),
+        default="sync",
+        help="Run fetching, embedding and updating one after another or as overlapping asyncio stages.",
+    )
+    developer_args.add_argument(
+        "-pqs",
+        "--pipeline-queue-size",
+        type=int,
+        default=4,
+        help="Maximum number of batches waiting between stages of the async pipeline.",
+    )
+    developer_args.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes, each indexing a disjoint hash partition of the collection.",
+    )
+    developer_args.add_argument(
+        "-pfq",
+        "--partition-fq",
+        type=str,
+        nargs="+",
+        help="Explicit filter query per worker partition, used instead of hash partitioning (one worker per filter).",
+    )
+    developer_args.add_argument(
+        "-pp",
+        "--prefetch-pages",
+        type=int,
+        default=0,
+        help="Number of Solr pages to fetch ahead on a background thread (0 disables prefetching).",
+    )
+    developer_args.add_argument(
+        "-sp",
+        "--stream-parse",
+        action="store_true",
+        help="Stream-parse Solr pages with ijson instead of decoding each page at once.",
+    )
+
+    retry_parser = subparsers.add_parser(
+        "retry",
+        help="Reindex the documents recorded in the failure log.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    add_indexer_arguments(retry_parser)
+    retry_args = retry_parser.add_argument_group("Retry Args")
+    retry_args.add_argument(
+        "-lbs",
+        "--lookup-batch-size",
+        type=int,
+        default=500,
+        help="Number of failed document IDs fetched per Solr terms lookup.",
+    )
+    retry_args.add_argument(
+        "-ma",
+        "--max-attempts",
+        type=int,
+        default=5,
+        help="Skip documents that have already failed this many times (0 retries all).",
+    )
+
+    index_parser = subparsers.add_parser(
+        "build-index",
+        help="Build a local memory-mapped vector index from the vectors stored in Solr.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    index_args = add_stored_vector_arguments(
+        index_parser, "Index Args", "Directory the index is written to."
+    )
+    index_args.add_argument(
+        "-idt",
+        "--index-dtype",
+        choices=INDEX_DTYPES,
+        default="float32",
+        help="Float precision of the vectors stored in the index.",
+    )
+    index_args.add_argument(
+        "-nl",
+        "--nlist",
+        type=int,
+        default=0,
+        help="Number of IVF lists trained for approximate search (0 builds an exact-only index).",
+    )
+    index_args.add_argument(
+        "-ki",
+        "--kmeans-iterations",
+        type=int,
+        default=10,
+        help="Number of k-means iterations used to train the IVF lists.",
+    )
+    index_args.add_argument(
+        "-ss",
+        "--sample-size",
+        type=int,
+        default=100_000,
+        help="Number of vectors sampled to train the IVF lists.",
+    )
+
+    export_parser = subparsers.add_parser(
+        "export",
+        help="Export the vectors stored in Solr to .npy shards for a later import.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    export_args = add_stored_vector_arguments(
+        export_parser,
+        "Export Args",
+        "Directory the shards and manifest are written to.",
+    )
+    export_args.add_argument(
+        "-shs",
+        "--shard-size",
+        type=int,
+        default=100_000,
+        help="Number of vectors written per shard.",
+    )
+    export_args.add_argument(
+        "-edt",
+        "--export-dtype",
+        choices=SHARD_DTYPES,
+        default="float32",
+        help="Float precision of the exported vectors (float32 imports back unchanged).",
+    )
+
+    import_parser = subparsers.add_parser(
+        "import",
+        help="Load exported vector shards back into Solr without re-embedding.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    add_solr_arguments(import_parser)
+    import_args = import_parser.add_argument_group("Import Args")
+    import_args.add_argument(
+        "-in",
+        "--input",
+        type=str,
+        required=True,
+        help="Directory of an export written by the export command.",
+    )
+    import_args.add_argument(
+        "-vf",
+        "--vector-field",
+        type=str,
+        help="Solr field the vectors are written to (defaults to the exported field).",
+    )
+    import_args.add_argument(
+        "-sk",
+        "--skip",
+        type=int,
+        default=0,
+        help="Number of exported vectors to skip, used to continue an interrupted import.",
+    )
+    import_args.add_argument(
+        "-fl",
+        "--failure-log",
+        type=str,
+        help=f"Append-only JSONL log of documents that failed to import (defaults to .<collection>{IMPORT_FAILURE_LOG_SUFFIX}.jsonl).",
+    )
+    import_args.add_argument(
+        "-vp",
+        "--vector-precision",
+        type=int,
+        default=DEFAULT_PRECISION,
+        help="Significant digits written per vector component (9 round-trips float32 exactly).",
+    )
+    import_args.add_argument(
+        "-ubs",
+        "--update-batch-size",
+        type=int,
+        default=500,
+        help="Maximum number of documents sent to Solr per update request.",
+    )
+    import_args.add_argument(
+        "-ubb",
+        "--update-batch-bytes",
+        type=int,
+        default=5_000_000,
+        help="Maximum payload size in bytes of a single Solr update request.",
+    )
+    import_args.add_argument(
+        "-cw",
+        "--commit-within",
+        type=int,
+        default=1000,
+        help="Milliseconds within which Solr should commit each update batch.",
+    )
+    import_args.add_argument(
+        "-dc",
+        "--defer-commit",
+        action="store_true",
+        help="Skip commitWithin on update batches and send a single commit when the import ends.",
+    )
 
     list_checkpoints.set_defaults(
         func=print_saved_checkpoints,
@@ -416,25 +1731,106 @@ if __name__ == "__main__":
         checkpoint_suffix=CHECKPOINT_SUFFIX,
         parser_type="util",
     )
-    parser.set_defaults(parser_type="main")
+    parser.set_defaults(parser_type="main", checkpoint_suffix=CHECKPOINT_SUFFIX)
+    retry_parser.set_defaults(parser_type="retry")
+    index_parser.set_defaults(parser_type="index")
+    export_parser.set_defaults(parser_type="export")
+    import_parser.set_defaults(parser_type="import")
 
     args = parent_parser.parse_args()
 
     if args.parser_type == "util":
         args.func(args)
+    elif args.parser_type == "index":
+        if args.buffer_size < 1:
+            index_parser.error("--buffer-size must be at least 1.")
+        logger.auto_configure(
+            args.debug, LOGGING_FILE, async_logging=args.async_logging
+        )
+        build_vector_index(args)
+    elif args.parser_type == "export":
+        if args.buffer_size < 1:
+            export_parser.error("--buffer-size must be at least 1.")
+        if args.shard_size < 1:
+            export_parser.error("--shard-size must be at least 1.")
+        logger.auto_configure(
+            args.debug, LOGGING_FILE, async_logging=args.async_logging
+        )
+        export_vectors(args)
+    elif args.parser_type == "import":
+        if args.update_batch_size < 1:
+            import_parser.error("--update-batch-size must be at least 1.")
+        if args.vector_precision < 1:
+            import_parser.error("--vector-precision must be at least 1.")
+        if args.skip < 0:
+            import_parser.error("--skip cannot be negative.")
+        logger.auto_configure(
+            args.debug, LOGGING_FILE, async_logging=args.async_logging
+        )
+        counts = import_vectors(args)
+        logger.info(f"Total updated: {counts[0]}. Total Failed: {counts[1]}")
+    elif args.parser_type == "retry":
+        if args.embed_batch_size < 1:
+            retry_parser.error("--embed-batch-size must be at least 1.")
+        if args.update_batch_size < 1:
+            retry_parser.error("--update-batch-size must be at least 1.")
+        if args.vector_precision < 1:
+            retry_parser.error("--vector-precision must be at least 1.")
+        if args.lookup_batch_size < 1:
+            retry_parser.error("--lookup-batch-size must be at least 1.")
+        if args.metrics_interval <= 0:
+            retry_parser.error("--metrics-interval must be positive.")
+        if args.log_every < 1:
+            retry_parser.error("--log-every must be at least 1.")
+        args.field_mappings = parse_field_mappings(retry_parser, args)
+        if not args.socket_path and not (args.request_file and args.recieve_file):
+            retry_parser.error(
+                "Either --socket-path or both --request-file and --recieve-file are required."
+            )
+        logger.auto_configure(
+            args.debug, LOGGING_FILE, async_logging=args.async_logging
+        )
+        counts = retry_failed(args)
+        logger.info(f"Total updated: {counts[0]}. Still failing: {counts[1]}")
     else:
-        logger.auto_configure(args.debug, LOGGING_FILE)
-        counts = main(
-            args.host,
-            args.port,
-            args.collection,
-            args.request_file,
-            args.recieve_file,
-            CHECKPOINT_SUFFIX,
-            args.resume_checkpoint,
-            args.query,
-            args.sort,
-            args.buffer_size,
+        if args.embed_batch_size < 1:
+            parser.error("--embed-batch-size must be at least 1.")
+        if args.update_batch_size < 1:
+            parser.error("--update-batch-size must be at least 1.")
+        if args.vector_precision < 1:
+            parser.error("--vector-precision must be at least 1.")
+        if args.metrics_interval <= 0:
+            parser.error("--metrics-interval must be positive.")
+        if args.log_every < 1:
+            parser.error("--log-every must be at least 1.")
+        args.field_mappings = parse_field_mappings(parser, args)
+        if args.partition_fq:
+            args.workers = len(args.partition_fq)
+        if args.workers < 1:
+            parser.error("--workers must be at least 1.")
+        if args.workers > 1 and not args.socket_path:
+            parser.error("Multiple workers require an embedding server --socket-path.")
+        if not args.socket_path and not (args.request_file and args.recieve_file):
+            parser.error(
+                "Either --socket-path or both --request-file and --recieve-file are required."
+            )
+        logger.auto_configure(
+            args.debug, LOGGING_FILE, async_logging=args.async_logging
         )
+        run_started = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        if args.workers > 1 or args.partition_fq:
+            counts = run_partitioned(args)
+        else:
+            counts = run_indexer(args)
+
+        state_file = f".{args.collection}{LAST_RUN_SUFFIX}.json"
+        if args.resume_checkpoint:
+            logger.info("Resumed runs are not recorded as the last successful run.")
+        elif counts[2]:
+            save_last_run(state_file, run_started)
+        else:
+            logger.warning(
+                "Run was interrupted or had failures. Not recording it as the last successful run."
+            )
 
         logger.info(f"Total updated: {counts[0]}. Total Failed: {counts[1]}")
@@ -1,8 +1,9 @@
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-import numpy as np
-import pickle
-from io import IOBase, BufferedReader, BytesIO
-import requests
+from itertools import combinations
+import argparse
+import csv
+import json
 from tabulate import tabulate
 from itertools import zip_longest
 import termios
@@ -10,83 +11,327 @@ import sys
 import tty
 import os
 from utils.console_utils import Loader
+from utils.solr_utils import Solr
+from utils.cache_utils import EmbeddingCache
+from utils.vector_utils import DEFAULT_PRECISION, format_vector
+from utils.index_utils import VectorIndex
+from utils.embedding_utils import (
+    DEFAULT_MODEL,
+    DEFAULT_SOCKET_PATH,
+    EmbeddingClient,
+    create_embedding_client,
+)
 import time
 
+import numpy as np
+
 class QueryType(Enum):
     EDISMAX = 'edismax'
     VECTOR = 'vector'
     HYBRID = 'hybrid'
 
-def send_embedding_request(sentences: list[str], medium: IOBase):
-    if medium.readable():
-        print("Medium must be write only..")
-        return False
-    if any([not x for x in sentences]):
-        print("Cannot embed empty text.")
-        return False
-
-    pickle.dump(sentences, medium)
-    return True
-
-
-def recieve_embeddings(recieve_file: BufferedReader) -> np.ndarray:
-    if recieve_file.writable():
-        print("Recieve file must be read only.")
-        return np.ndarray((1,))
-    buffer = BytesIO(recieve_file.read())
-    buffer.seek(0)
-    return np.load(buffer)
-
-def generate_vector_query(query: str, page: int, rows: int, request_file: str, reply_file: str):
-    with open(request_file, "wb") as f:
-        send_embedding_request([query], f)
+def embed_query(query: str, embedder: EmbeddingClient) -> np.ndarray:
+    embedded_query = embedder.embed([query])
+    if embedded_query is None:
+        raise RuntimeError(f"Could not embed query: '{query}'")
+    return embedded_query[0]
 
-    with open(reply_file, "rb") as f:
-        embedded_query = recieve_embeddings(f)
-    embedded_query = [float(x) for x in embedded_query[0]]
 
-    return f"{{!knn f=title_bert_vector topK={(page + 1) * rows}}}{embedded_query}"
+def generate_vector_query(vector: np.ndarray, page: int, rows: int, precision: int = DEFAULT_PRECISION):
+    return f"{{!knn f=title_bert_vector topK={(page + 1) * rows}}}{format_vector(vector, precision)}"
 
 
-def query_solr(query_type: QueryType, query: str, request_file: str, reply_file: str, page: int, rows: int):
+def query_solr(solr: Solr, query_type: QueryType, query: str, vector: np.ndarray | None, page: int, rows: int, precision: int = DEFAULT_PRECISION):
     start = time.perf_counter()
 
     edismax_query = f"{{!edismax qf='original_dc_title^5 original_dc_description_abstract^2'}}{query}"
     rerank_query = "{!rerank reRankQuery=$rqq reRankDocs=50 reRankWeight=3}"
 
 
-    params = {"wt": "json", "fl": "original_dc_title score", "start": page * rows, "rows": rows}
+    params = {"wt": "json", "fl": "id original_dc_title score", "start": page * rows, "rows": rows}
+
+    if query_type != QueryType.EDISMAX and vector is None:
+        raise RuntimeError(f"No embedding available for query: '{query}'")
 
     if query_type == QueryType.EDISMAX:
         params["q"] = edismax_query
     elif query_type == QueryType.VECTOR:
-        vector_query = generate_vector_query(query, page, rows, request_file, reply_file)
-        params["q"] = vector_query
+        params["q"] = generate_vector_query(vector, page, rows, precision)
     elif query_type == QueryType.HYBRID:
-        vector_query = generate_vector_query(query, page, rows, request_file, reply_file)
-        params["q"] = vector_query
+        params["q"] = generate_vector_query(vector, page, rows, precision)
         params["rqq"] = edismax_query
         params["rq"] = rerank_query
 
-    response = requests.post(
-        "http://localhost:8984/solr/adri_documents/query",
-        json={"params": params},
-        headers={"Content-type": "application/json"},
-    )
+    response = solr.query(params)
+    solr_time = time.perf_counter() - start
 
-    results = {"title": [], "score": [], "time_taken": []}
+    results = {"id": [], "title": [], "score": [], "time_taken": [], "solr_time": solr_time}
     if response.status_code != 200:
         print(response.text)
         return results
     else:
         for doc in response.json()["response"]["docs"]:
+            results["id"].append(doc['id'])
             results["title"].append(doc['original_dc_title'])
             results['score'].append(doc['score'])
             results['time_taken'].append(time.perf_counter() - start)
         return results
 
-def build_result(request_file: str, reply_file: str, query: str, page:int, rows: int):
-    return lambda query_type: query_solr(query_type, query, request_file, reply_file, page, rows)
+class VectorWindow:
+    """
+    Ranked ids and scores of a vector query, kept client-side so that paging
+    does not make Solr recompute an ever larger kNN. The ranking is fetched
+    window_size results at a time and pages only fetch their display fields.
+    """
+
+    def __init__(self, solr: Solr, query_type: QueryType, query: str, vector: np.ndarray, window_size: int = 100, precision: int = DEFAULT_PRECISION):
+        self.solr = solr
+        self.query_type = query_type
+        self.query = query
+        self.vector = vector
+        self.window_size = window_size
+        self.precision = precision
+        self.ids: list[str] = []
+        self.scores: list[float] = []
+        self._seen: set[str] = set()
+        self._offset = 0
+        self.exhausted = False
+
+    def _refill(self, needed: int):
+        while len(self.ids) < needed and not self.exhausted:
+            top_k = self._offset + self.window_size
+            params = {
+                "wt": "json",
+                "fl": "id score",
+                "q": f"{{!knn f=title_bert_vector topK={top_k}}}{format_vector(self.vector, self.precision)}",
+                "start": self._offset,
+                "rows": self.window_size,
+            }
+            if self.query_type == QueryType.HYBRID:
+                # Only the first window is reranked. Growing reRankDocs with topK would reorder results that earlier windows already returned.
+                params["rqq"] = f"{{!edismax qf='original_dc_title^5 original_dc_description_abstract^2'}}{self.query}"
+                params["rq"] = f"{{!rerank reRankQuery=$rqq reRankDocs={self.window_size} reRankWeight=3}}"
+
+            response = self.solr.query(params)
+            if response.status_code != 200:
+                print(response.text)
+                return
+            docs = response.json()["response"]["docs"]
+            self._offset += len(docs)
+            for doc in docs:
+                if doc["id"] not in self._seen:
+                    self._seen.add(doc["id"])
+                    self.ids.append(doc["id"])
+                    self.scores.append(doc["score"])
+            if len(docs) < self.window_size:
+                self.exhausted = True
+
+    def page(self, page: int, rows: int):
+        start = time.perf_counter()
+        self._refill((page + 1) * rows)
+        ids = self.ids[page * rows : (page + 1) * rows]
+        scores = self.scores[page * rows : (page + 1) * rows]
+
+        titles = {}
+        if ids:
+            docs = self.solr.get_documents(ids, ["id", "original_dc_title"]) or []
+            titles = {doc["id"]: doc.get("original_dc_title") for doc in docs}
+
+        solr_time = time.perf_counter() - start
+        return {
+            "id": ids,
+            "title": [titles.get(doc_id) for doc_id in ids],
+            "score": scores,
+            "time_taken": [solr_time] * len(ids),
+            "solr_time": solr_time,
+        }
+
+
+def create_windows(solr: Solr, query: str, vector: np.ndarray | None, window_size: int, precision: int = DEFAULT_PRECISION):
+    if vector is None:
+        return {}
+    return {
+        query_type: VectorWindow(solr, query_type, query, vector, window_size, precision)
+        for query_type in (QueryType.VECTOR, QueryType.HYBRID)
+    }
+
+
+def query_local(index: VectorIndex, solr: Solr | None, vector: np.ndarray, page: int, rows: int, nprobe: int = 0):
+    start = time.perf_counter()
+    ids, scores = index.search(vector, (page + 1) * rows, nprobe)
+    ids, scores = ids[page * rows :], scores[page * rows :].tolist()
+    search_time = time.perf_counter() - start
+
+    titles = {}
+    if solr is not None and ids:
+        docs = solr.get_documents(ids, ["id", "original_dc_title"]) or []
+        titles = {doc["id"]: doc.get("original_dc_title") for doc in docs}
+    return {
+        "id": ids,
+        "title": [titles.get(doc_id) for doc_id in ids],
+        "score": scores,
+        "time_taken": [time.perf_counter() - start] * len(ids),
+        "solr_time": search_time,
+    }
+
+
+def query_all(executor: ThreadPoolExecutor, solr: Solr, query: str, vector: np.ndarray | None, page: int, rows: int, precision: int = DEFAULT_PRECISION, windows: dict[QueryType, VectorWindow] | None = None, index: VectorIndex | None = None, nprobe: int = 0):
+    """
+    Sends the query types to Solr in parallel. Vector types are skipped when the query has no embedding.
+    With a local index the vector type is answered from it instead of Solr.
+    """
+    windows = windows or {}
+    futures = {}
+    for query_type in QueryType:
+        if query_type == QueryType.VECTOR and index is not None and vector is not None:
+            futures[query_type] = executor.submit(query_local, index, solr, vector, page, rows, nprobe)
+        elif query_type in windows:
+            futures[query_type] = executor.submit(windows[query_type].page, page, rows)
+        elif query_type == QueryType.EDISMAX or vector is not None:
+            futures[query_type] = executor.submit(query_solr, solr, query_type, query, vector, page, rows, precision)
+    return {query_type: future.result() for query_type, future in futures.items()}
+
+def latency_summary(values: list[float]):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "mean": None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99), "mean": float(np.mean(values))}
+
+
+def run_query(executor: ThreadPoolExecutor, solr: Solr, embedder: EmbeddingClient, query: str, rows: int, precision: int = DEFAULT_PRECISION, index: VectorIndex | None = None, nprobe: int = 0):
+    start = time.perf_counter()
+    try:
+        vector = embed_query(query, embedder)
+        error = None
+    except RuntimeError as e:
+        vector = None
+        error = str(e)
+    embed_time = time.perf_counter() - start
+
+    results = query_all(executor, solr, query, vector, 0, rows, precision, index=index, nprobe=nprobe)
+    wall_time = time.perf_counter() - start
+
+    records = []
+    for query_type in QueryType:
+        result = results.get(query_type)
+        if result is None:
+            records.append({"query": query, "mode": query_type.value, "embed_time": None, "solr_time": None, "total_time": None, "hits": 0, "ids": [], "error": error})
+            continue
+        mode_embed_time = 0.0 if query_type == QueryType.EDISMAX else embed_time
+        records.append({
+            "query": query,
+            "mode": query_type.value,
+            "embed_time": mode_embed_time,
+            "solr_time": result["solr_time"],
+            "total_time": mode_embed_time + result["solr_time"],
+            "hits": len(result["id"]),
+            "ids": result["id"],
+            "error": None,
+        })
+    return records, wall_time
+
+
+def run_batch(executor: ThreadPoolExecutor, solr: Solr, embedder: EmbeddingClient, queries: list[str], rows: int, precision: int = DEFAULT_PRECISION, warmup: int = 0, index: VectorIndex | None = None, nprobe: int = 0):
+    for query in queries[:warmup]:
+        run_query(executor, solr, embedder, query, rows, precision, index, nprobe)
+
+    records = []
+    wall_times = []
+    for query in queries:
+        query_records, wall_time = run_query(executor, solr, embedder, query, rows, precision, index, nprobe)
+        records.extend(query_records)
+        wall_times.append(wall_time)
+    return records, wall_times
+
+
+def benchmark_index(index: VectorIndex, vectors: list[np.ndarray], rows: int, nprobes: list[int]):
+    """Measures search latency and recall@rows against exact search for every nprobe setting."""
+    exact = [index.search(vector, rows)[0] for vector in vectors]
+    benchmark = {}
+    for nprobe in sorted(set([0] + nprobes)):
+        times, recalls = [], []
+        for vector, reference in zip(vectors, exact):
+            start = time.perf_counter()
+            ids, _ = index.search(vector, rows, nprobe)
+            times.append(time.perf_counter() - start)
+            if reference:
+                recalls.append(len(set(ids) & set(reference)) / len(reference))
+        benchmark[str(nprobe)] = {**latency_summary(times), f"recall@{rows}": float(np.mean(recalls)) if recalls else None}
+    return benchmark
+
+
+def print_index_benchmark(benchmark: dict, rows: int):
+    benchmark_rows = []
+    for nprobe, values in benchmark.items():
+        benchmark_rows.append(["exact" if nprobe == "0" else nprobe] + [None if values[p] is None else round(values[p] * 1000, 3) for p in ("p50", "p95", "p99", "mean")] + [values[f"recall@{rows}"]])
+    print("Local index search (ms):")
+    print(tabulate(benchmark_rows, headers=["nprobe", "p50", "p95", "p99", "Mean", f"Recall@{rows}"], tablefmt="fancy_grid"))
+
+
+def summarize_batch(records: list[dict], wall_times: list[float], rows: int):
+    latency = {}
+    for query_type in QueryType:
+        mode_records = [r for r in records if r["mode"] == query_type.value and r["error"] is None]
+        latency[query_type.value] = {
+            stage: latency_summary([r[f"{stage}_time"] for r in mode_records])
+            for stage in ("embed", "solr", "total")
+        }
+
+    by_query = {}
+    for record in records:
+        by_query.setdefault(record["query"], {})[record["mode"]] = record["ids"][:rows]
+
+    # Recall uses the first mode of each pair as the reference result list.
+    agreement = {}
+    for reference, other in combinations([query_type.value for query_type in QueryType], 2):
+        overlaps, recalls = [], []
+        for results in by_query.values():
+            if reference not in results or other not in results:
+                continue
+            shared = len(set(results[reference]) & set(results[other]))
+            overlaps.append(shared / rows)
+            if results[reference]:
+                recalls.append(shared / len(results[reference]))
+        agreement[f"{reference}/{other}"] = {
+            f"overlap@{rows}": float(np.mean(overlaps)) if overlaps else None,
+            f"recall@{rows}": float(np.mean(recalls)) if recalls else None,
+        }
+
+    return {"queries": len(by_query), "rows": rows, "latency": latency, "wall": latency_summary(wall_times), "agreement": agreement}
+
+
+def write_batch_results(path: str, records: list[dict], summary: dict) -> list[str]:
+    """CSV only holds the per-query rows, so the summary is written next to it as <name>.summary.json."""
+    if not path.endswith(".csv"):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"summary": summary, "results": records}, f, indent=4)
+        return [path]
+
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["query", "mode", "embed_time", "solr_time", "total_time", "hits", "ids", "error"])
+        writer.writeheader()
+        for record in records:
+            writer.writerow({**record, "ids": " ".join(record["ids"])})
+    summary_path = f"{path[: -len('.csv')]}.summary.json"
+    with open(summary_path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=4)
+    return [path, summary_path]
+
+
+def print_batch_summary(summary: dict):
+    latency_rows = []
+    for mode, stages in summary["latency"].items():
+        for stage, values in stages.items():
+            latency_rows.append([mode, stage] + [None if values[p] is None else round(values[p] * 1000, 2) for p in ("p50", "p95", "p99", "mean")])
+    print(f"Latency over {summary['queries']} queries (ms):")
+    wall = summary["wall"]
+    latency_rows.append(["all", "wall"] + [None if wall[p] is None else round(wall[p] * 1000, 2) for p in ("p50", "p95", "p99", "mean")])
+    print(tabulate(latency_rows, headers=["Mode", "Stage", "p50", "p95", "p99", "Mean"], tablefmt="fancy_grid"))
+
+    agreement_rows = [[pair] + list(values.values()) for pair, values in summary["agreement"].items()]
+    print(f"Agreement between modes at k={summary['rows']}:")
+    print(tabulate(agreement_rows, headers=["Modes", f"Overlap@{summary['rows']}", f"Recall@{summary['rows']}"], tablefmt="fancy_grid"))
+
 
 def slice_value(value, start, end):
     if start > len(value) - 1:
@@ -155,9 +400,68 @@ if __name__ == "__main__":
     REQUEST_FILE = "./request.fifo"
     REPLY_FILE = "./reply.fifo"
 
+    arg_parser = argparse.ArgumentParser("Solr Query Comparison", allow_abbrev=False)
+    arg_parser.add_argument("-r", "--request-file", type=str, default=REQUEST_FILE, help="Path to file used for sending the embeddings request.")
+    arg_parser.add_argument("-s", "--reply-file", type=str, default=REPLY_FILE, help="Path to file used for recieving the embedding result.")
+    arg_parser.add_argument("-u", "--socket-path", type=str, help=f"Unix domain socket of an embedding server (e.g. {DEFAULT_SOCKET_PATH}). Takes precedence over the named pipes.")
+    arg_parser.add_argument("-cs", "--cache-size", type=int, default=1000, help="Number of query embeddings kept in the in-memory LRU cache. Batch mode runs without the cache.")
+    arg_parser.add_argument("-cf", "--cache-file", type=str, help="Path of an sqlite database used to persist cached embeddings.")
+    arg_parser.add_argument("-mn", "--model-name", type=str, default=DEFAULT_MODEL, help="Name of the model served by the embedding server.")
+    arg_parser.add_argument("-vp", "--vector-precision", type=int, default=DEFAULT_PRECISION, help="Significant digits written per component of the query vector.")
+    arg_parser.add_argument("-qf", "--queries-file", type=str, help="Run every query in this file (one per line) non-interactively and report latency and agreement between modes.")
+    arg_parser.add_argument("-k", "--rows", type=int, default=10, help="Number of results requested per query in batch mode.")
+    arg_parser.add_argument("-w", "--warmup", type=int, default=0, help="Number of queries run once before measuring in batch mode.")
+    arg_parser.add_argument("-o", "--output", type=str, help="Write batch results to this file (.csv for per-query rows with the summary in a sibling .summary.json, JSON otherwise).")
+    arg_parser.add_argument("-pm", "--paging", choices=("window", "start"), default="window", help="Serve vector pages from a cached window of kNN results, or rerun the kNN with a larger topK and start offset for every page.")
+    arg_parser.add_argument("-ws", "--window-size", type=int, default=100, help="Number of ranked vector results fetched at once in window paging.")
+    arg_parser.add_argument("-ix", "--index", type=str, help="Directory of a local vector index built with 'populate-solr-vectors.py build-index'. Answers the vector mode instead of Solr.")
+    arg_parser.add_argument("-np", "--nprobe", type=int, nargs="+", default=[0], help="IVF lists searched in the local index (0 searches exactly). Batch mode benchmarks every value given, the first one is used for queries.")
+    arg_parser.add_argument("-lo", "--local-only", action="store_true", help="In batch mode only benchmark the local index, without sending any query to Solr.")
+    args = arg_parser.parse_args()
+
+    solr = Solr("localhost", 8984, "adri_documents")
+    # Batch mode measures embedding latency, which cache hits from warmup or repeated queries would hide.
+    cache = None if args.queries_file else EmbeddingCache(args.model_name, args.cache_size, args.cache_file)
+    embedder = create_embedding_client(args.socket_path, args.request_file, args.reply_file, cache=cache)
+    executor = ThreadPoolExecutor(max_workers=len(QueryType))
+    index = VectorIndex(args.index) if args.index else None
+    nprobe = args.nprobe[0]
+
+    if args.queries_file:
+        if args.rows < 1:
+            arg_parser.error("--rows must be at least 1.")
+        if args.local_only and index is None:
+            arg_parser.error("--local-only requires an --index.")
+        if args.local_only and args.output and args.output.endswith(".csv"):
+            arg_parser.error("--local-only produces no per-query rows. Write the --output as JSON instead of CSV.")
+        with open(args.queries_file, "r", encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+        records, summary = [], {}
+        if not args.local_only:
+            records, wall_times = run_batch(executor, solr, embedder, queries, args.rows, args.vector_precision, args.warmup, index, nprobe)
+            summary = summarize_batch(records, wall_times, args.rows)
+            print_batch_summary(summary)
+        if index is not None:
+            vectors = []
+            for query in queries:
+                try:
+                    vectors.append(embed_query(query, embedder))
+                except RuntimeError as e:
+                    print(e)
+            summary["index"] = benchmark_index(index, vectors, args.rows, args.nprobe)
+            print_index_benchmark(summary["index"], args.rows)
+        if args.output:
+            written = write_batch_results(args.output, records, summary)
+            print(f"Results written to: {', '.join(written)}")
+        embedder.close()
+        executor.shutdown()
+        sys.exit(0)
 
     page = 0
     last_index = 0
+    vector = None
+    windows = None
+    embedded_for = None
     print("\033[H\033[J", end="")
     query = input("Enter search query: ")
     rows = input("How many documents should be returned per page? [default: 10]: ")
@@ -169,15 +473,16 @@ if __name__ == "__main__":
         while True:
             print("\033[H\033[J", end="")
             data = {}
-            result_builder = build_result(REQUEST_FILE, REPLY_FILE, query, page, rows)
-            edismax_result = {'title': [], 'score': []} 
-            vector_result = {'title': [], 'score': []}
-            hybrid_result = {'title': [], 'score': []}
-
             with Loader("Fetching documents..."):
-                edismax_result = result_builder(QueryType.EDISMAX)
-                vector_result = result_builder(QueryType.VECTOR)
-                hybrid_result = result_builder(QueryType.HYBRID)
+                if embedded_for != query:
+                    vector = embed_query(query, embedder)
+                    embedded_for = query
+                    if args.paging == "window":
+                        windows = create_windows(solr, query, vector, max(args.window_size, rows), args.vector_precision)
+                results = query_all(executor, solr, query, vector, page, rows, args.vector_precision, windows, index, nprobe)
+            edismax_result = results[QueryType.EDISMAX]
+            vector_result = results[QueryType.VECTOR]
+            hybrid_result = results[QueryType.HYBRID]
 
         
             concater = concat_lists_builder("edismax", "vector", "hybrid", 120)
@@ -217,6 +522,9 @@ if __name__ == "__main__":
                 else:
                     print("Invalid key...")
     except KeyboardInterrupt:
+        print(f"Embedding cache stats: {cache.stats()}")
+        embedder.close()
+        executor.shutdown(cancel_futures=True)
         print("Exitting...")
 
 
@@ -0,0 +1,184 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib.parse import parse_qs, urlparse
+import importlib.util
+import json
+import os
+import signal
+import sys
+import time
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+spec = importlib.util.spec_from_file_location(
+    "populate_solr_vectors", os.path.join(ROOT, "populate-solr-vectors.py")
+)
+populate = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(populate)
+
+DOC_IDS = [f"doc{i:04d}" for i in range(200)]
+
+
+class _SolrHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body: dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        mark = params["cursorMark"][0]
+        rows = int(params["rows"][0])
+        start = 0 if mark == "*" else DOC_IDS.index(mark) + 1
+        page = DOC_IDS[start : start + rows]
+        self._send(
+            {
+                "response": {
+                    "numFound": len(DOC_IDS),
+                    "docs": [
+                        {"id": doc_id, "original_dc_title": f"title of {doc_id}"}
+                        for doc_id in page
+                    ],
+                },
+                "nextCursorMark": page[-1] if page else mark,
+            }
+        )
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self._send({"responseHeader": {"status": 0}})
+
+
+class FailingEmbedder:
+    def __init__(self, fail_on: int = 0) -> None:
+        self.calls = 0
+        self.fail_on = fail_on
+
+    def embed(self, sentences: list[str]) -> np.ndarray:
+        self.calls += 1
+        if self.calls == self.fail_on:
+            raise RuntimeError("Stage failed.")
+        return np.ones((len(sentences), 4), dtype=np.float32)
+
+
+@pytest.fixture
+def solr_port():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _SolrHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def hang_guard():
+    def timed_out(*_):
+        raise TimeoutError("The pipeline did not finish.")
+
+    previous = signal.signal(signal.SIGALRM, timed_out)
+    signal.alarm(30)
+    yield
+    signal.alarm(0)
+    signal.signal(signal.SIGALRM, previous)
+
+
+def run_main(port: int, embedder, tmp_path, pipeline: str):
+    return populate.main(
+        "127.0.0.1",
+        port,
+        "test",
+        embedder,
+        populate.FailureLog(str(tmp_path / "failures.jsonl")),
+        "-checkpoint",
+        False,
+        1000,
+        60,
+        "*:*",
+        "id asc",
+        10,
+        10,
+        5,
+        5_000_000,
+        1000,
+        2,
+        0,
+        0,
+        0,
+        "model",
+        False,
+        "fingerprint",
+        [populate.FieldMapping("original_dc_title", "title_bert_vector")],
+        populate.TextChunker(),
+        False,
+        "modified",
+        False,
+        6,
+        0,
+        0,
+        pipeline,
+        2,
+    )
+
+
+@pytest.mark.parametrize("pipeline", ["sync", "async"])
+@pytest.mark.parametrize("stage", ["embed", "update"])
+def test_failing_stage_aborts_and_saves_checkpoint(
+    tmp_path, monkeypatch, solr_port, hang_guard, pipeline, stage
+):
+    monkeypatch.chdir(tmp_path)
+    embedder = FailingEmbedder(fail_on=4 if stage == "embed" else 0)
+    if stage == "update":
+        queue_updates = populate.queue_updates
+        calls = []
+
+        def failing_queue_updates(*args):
+            calls.append(None)
+            if len(calls) == 2:
+                # Gives the earlier stages time to fill both queues.
+                time.sleep(1)
+                raise RuntimeError("Stage failed.")
+            queue_updates(*args)
+
+        monkeypatch.setattr(populate, "queue_updates", failing_queue_updates)
+
+    with pytest.raises(RuntimeError, match="Stage failed."):
+        run_main(solr_port, embedder, tmp_path, pipeline)
+
+    with open(tmp_path / ".test-checkpoint.json", "r", encoding="utf-8") as f:
+        checkpoint = json.load(f)
+    assert checkpoint["last_committed"]["position"] <= 30
+
+
+class NaNEmbedder:
+    def __init__(self, bad_sentence: str) -> None:
+        self.bad_sentence = bad_sentence
+
+    def embed(self, sentences: list[str]) -> np.ndarray:
+        embeddings = np.ones((len(sentences), 4), dtype=np.float32)
+        embeddings[[s == self.bad_sentence for s in sentences]] = np.nan
+        return embeddings
+
+
+@pytest.mark.parametrize("pipeline", ["sync", "async"])
+def test_non_finite_embedding_only_fails_its_document(
+    tmp_path, monkeypatch, solr_port, hang_guard, pipeline
+):
+    monkeypatch.chdir(tmp_path)
+    updated, failed, succeeded = run_main(
+        solr_port, NaNEmbedder("title of doc0013"), tmp_path, pipeline
+    )
+
+    assert (updated, failed, succeeded) == (len(DOC_IDS) - 1, 1, False)
+    failures = populate.FailureLog(str(tmp_path / "failures.jsonl"))
+    assert list(failures.pending) == ["doc0013"]
+    assert not os.path.exists(tmp_path / ".test-checkpoint.json")
@@ -0,0 +1,113 @@
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Lock
+import logging
+import sqlite3
+import unicodedata
+
+import numpy as np
+
+from utils.logging_utils import ColouredLogger
+
+logger: ColouredLogger = logging.getLogger(__name__)
+
+SQLITE_MAX_VARIABLES = 500
+
+
+def normalize_text(text: str) -> str:
+    return unicodedata.normalize("NFC", " ".join(text.split()))
+
+
+def text_fingerprint(model_name: str, text: str) -> str:
+    return sha256(f"{model_name}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(
+        self, model_name: str, capacity: int = 10_000, path: str | None = None
+    ) -> None:
+        self.model_name = model_name
+        self.capacity = capacity
+        self._entries: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._db: sqlite3.Connection | None = None
+        if path:
+            self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+            )
+            self._db.commit()
+
+    def key(self, text: str) -> str:
+        return text_fingerprint(self.model_name, text)
+
+    def _remember(self, key: str, vector: np.ndarray):
+        if self.capacity <= 0:
+            return
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def get_many(self, keys: list[str]) -> list[np.ndarray | None]:
+        with self._lock:
+            found: list[np.ndarray | None] = []
+            for key in keys:
+                vector = self._entries.get(key)
+                if vector is not None:
+                    self._entries.move_to_end(key)
+                found.append(vector)
+
+            missing = list({key for key, vector in zip(keys, found) if vector is None})
+            stored: dict[str, np.ndarray] = {}
+            if self._db is not None and missing:
+                for i in range(0, len(missing), SQLITE_MAX_VARIABLES):
+                    chunk = missing[i : i + SQLITE_MAX_VARIABLES]
+                    rows = self._db.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                        chunk,
+                    )
+                    for key, blob in rows:
+                        stored[key] = np.frombuffer(blob, dtype=np.float32)
+                for key, vector in stored.items():
+                    self._remember(key, vector)
+
+            for i, key in enumerate(keys):
+                if found[i] is not None:
+                    self.hits += 1
+                elif key in stored:
+                    found[i] = stored[key]
+                    self.disk_hits += 1
+                else:
+                    self.misses += 1
+            return found
+
+    def put_many(self, keys: list[str], vectors: np.ndarray):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock:
+            for key, vector in zip(keys, vectors):
+                self._remember(key, vector)
+            if self._db is not None:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                    [(key, vector.tobytes()) for key, vector in zip(keys, vectors)],
+                )
+                self._db.commit()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+            }
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
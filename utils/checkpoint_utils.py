@@ -0,0 +1,97 @@
+from collections import OrderedDict
+from threading import Lock
+import logging
+import os
+import time as t
+
+from utils.logging_utils import ColouredLogger
+
+logger: ColouredLogger = logging.getLogger(__name__)
+
+
+class CheckpointTracker:
+    """
+    Saves cursor checkpoints at the last document that is fully processed.
+
+    Batched and pipelined updates finish documents out of order, so the
+    checkpoint only moves past a document once every document traversed
+    before it has been written to Solr, skipped or given up on.
+    """
+
+    def __init__(
+        self, cursor, path: str, every_docs: int = 1000, every_seconds: float = 60
+    ) -> None:
+        self._cursor = cursor
+        self._path = path
+        self._every_docs = every_docs
+        self._every_seconds = every_seconds
+        self._lock = Lock()
+        self._positions: OrderedDict[int, dict[str, object]] = OrderedDict()
+        self._finished: set[int] = set()
+        self._in_flight: dict[str, int] = {}
+        self.last_committed: dict[str, object] | None = cursor.resumed_from
+        self._saved_position = cursor.total_scrolled
+        self._saved_at = t.monotonic()
+
+    def track(self, doc_id: str | None, finished: bool = False) -> int:
+        """Registers the document the cursor returned last."""
+        position = self._cursor.total_scrolled
+        with self._lock:
+            self._positions[position] = {
+                "id": doc_id,
+                "position": position,
+                "page_mark": self._cursor.page_mark,
+                "page_offset": self._cursor.page_offset,
+            }
+            if finished:
+                self._finished.add(position)
+                self._advance()
+            elif doc_id is not None:
+                self._in_flight[doc_id] = position
+        return position
+
+    def finish_ids(self, doc_ids: list[str], *_):
+        with self._lock:
+            for doc_id in doc_ids:
+                position = self._in_flight.pop(doc_id, None)
+                if position is not None:
+                    self._finished.add(position)
+            self._advance()
+
+    def _advance(self):
+        while self._positions:
+            position = next(iter(self._positions))
+            if position not in self._finished:
+                break
+            self._finished.discard(position)
+            self.last_committed = self._positions.pop(position)
+
+        if self.last_committed is None:
+            return
+        advanced = int(self.last_committed["position"]) - self._saved_position
+        if advanced <= 0:
+            return
+        if (self._every_docs > 0 and advanced >= self._every_docs) or (
+            self._every_seconds > 0
+            and t.monotonic() - self._saved_at >= self._every_seconds
+        ):
+            self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        temp_path = f"{self._path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            self._cursor.save(f, self.last_committed)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self._path)
+
+        if self.last_committed is not None:
+            self._saved_position = int(self.last_committed["position"])
+            logger.debug(
+                f"Saved checkpoint after document {self._saved_position} (ID: '{self.last_committed['id']}')."
+            )
+        self._saved_at = t.monotonic()
@@ -0,0 +1,65 @@
+import numpy as np
+
+POOLING_METHODS = ("mean", "max")
+DEFAULT_FIELD_MAP = "original_dc_title:title_bert_vector"
+
+
+class FieldMapping:
+    """A Solr text field embedded into a vector field, pooled over its chunks."""
+
+    def __init__(self, source: str, target: str, pooling: str = "mean") -> None:
+        if pooling not in POOLING_METHODS:
+            raise ValueError(f"Unsupported pooling method: {pooling}.")
+        self.source = source
+        self.target = target
+        self.pooling = pooling
+
+    @classmethod
+    def parse(cls, spec: str) -> "FieldMapping":
+        """Parses SOURCE:TARGET[:POOLING], e.g. original_dc_description_abstract:abstract_bert_vector:max."""
+        parts = spec.split(":")
+        if len(parts) not in (2, 3) or not all(parts):
+            raise ValueError(
+                f"Invalid field mapping '{spec}'. Expected SOURCE:TARGET[:{'|'.join(POOLING_METHODS)}]."
+            )
+        return cls(*parts)
+
+    def __repr__(self) -> str:
+        return f"{self.source}:{self.target}:{self.pooling}"
+
+
+class TextChunker:
+    """
+    Splits long texts into overlapping windows of whitespace separated words.
+    Texts that fit into one window are returned unchanged.
+    """
+
+    def __init__(self, window: int = 100, overlap: int = 20, max_chunks: int = 0):
+        if window < 1 or not 0 <= overlap < window:
+            raise ValueError("Chunk overlap must be smaller than the chunk window.")
+        self.window = window
+        self.overlap = overlap
+        self.max_chunks = max_chunks
+
+    def split(self, text: str) -> list[str]:
+        words = text.split()
+        if len(words) <= self.window:
+            return [text]
+        starts = range(0, len(words) - self.overlap, self.window - self.overlap)
+        if self.max_chunks > 0:
+            starts = starts[: self.max_chunks]
+        return [" ".join(words[start : start + self.window]) for start in starts]
+
+
+def pool_segments(
+    embeddings: np.ndarray, starts: np.ndarray, method: str
+) -> np.ndarray:
+    """
+    Reduces consecutive row segments to one row each. starts holds the first
+    row of every segment, and every segment must hold at least one row.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if method == "max":
+        return np.maximum.reduceat(embeddings, starts, axis=0)
+    counts = np.diff(np.append(starts, len(embeddings)))
+    return np.add.reduceat(embeddings, starts, axis=0) / counts[:, None]
@@ -0,0 +1,351 @@
+from io import BufferedReader, BytesIO, IOBase
+from itertools import count
+from threading import Lock
+from typing import Callable
+import json
+import logging
+import pickle
+import socket
+import struct
+
+import numpy as np
+
+from utils.cache_utils import EmbeddingCache
+from utils.logging_utils import ColouredLogger
+
+logger: ColouredLogger = logging.getLogger(__name__)
+
+# Every frame is a fixed header (request ID, frame kind, payload length)
+# followed by the payload bytes.
+FRAME_HEADER = struct.Struct("!QBI")
+REQUEST_FRAME = 1
+REPLY_FRAME = 2
+ERROR_FRAME = 3
+STATS_FRAME = 4
+
+DEFAULT_SOCKET_PATH = "embedding.sock"
+DEFAULT_MODEL = "bert-base-nli-mean-tokens"
+
+# Raw replies are a small header (magic, dtype code, rows, columns) followed
+# by the contiguous little-endian matrix bytes.
+RAW_MAGIC = b"EMB1"
+RAW_HEADER = struct.Struct("!4sBII")
+RAW_DTYPES = {0: np.dtype("<f4"), 1: np.dtype("<f2")}
+RAW_DTYPE_CODES = {"float32": 0, "float16": 1}
+REPLY_FORMATS = ("raw", "npy")
+
+
+class EmbeddingError(Exception):
+    pass
+
+
+def read_into(readinto: Callable[[memoryview], int | None], view: memoryview):
+    received = 0
+    while received < len(view):
+        n = readinto(view[received:])
+        if not n:
+            return False
+        received += n
+    return True
+
+
+def read_exact(sock: socket.socket, size: int) -> bytes | None:
+    buffer = bytearray(size)
+    if not read_into(sock.recv_into, memoryview(buffer)):
+        return None
+    return bytes(buffer)
+
+
+def read_frame_header(sock: socket.socket) -> tuple[int, int, int] | None:
+    header = read_exact(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    return FRAME_HEADER.unpack(header)
+
+
+def read_frame(sock: socket.socket) -> tuple[int, int, bytes] | None:
+    header = read_frame_header(sock)
+    if header is None:
+        return None
+    request_id, kind, length = header
+    payload = read_exact(sock, length)
+    if payload is None:
+        return None
+    return (request_id, kind, payload)
+
+
+def send_frame(sock: socket.socket, request_id: int, kind: int, *parts):
+    length = sum(memoryview(part).nbytes for part in parts)
+    sock.sendall(FRAME_HEADER.pack(request_id, kind, length))
+    for part in parts:
+        sock.sendall(part)
+
+
+def encode_request(
+    sentences: list[str], reply_format: str = "raw", reply_dtype: str = "float32"
+) -> bytes:
+    return json.dumps(
+        {"sentences": sentences, "format": reply_format, "dtype": reply_dtype}
+    ).encode("utf-8")
+
+
+def decode_request(payload: bytes) -> tuple[list[str], str, str]:
+    data = json.loads(payload.decode("utf-8"))
+    if not isinstance(data, dict):
+        raise EmbeddingError("Request must be a JSON object.")
+    sentences = data.get("sentences")
+    if not isinstance(sentences, list) or not all(
+        isinstance(x, str) and x for x in sentences
+    ):
+        raise EmbeddingError("Request must contain a list of non-empty sentences.")
+    reply_format = data.get("format", "npy")
+    reply_dtype = data.get("dtype", "float32")
+    if reply_format not in REPLY_FORMATS:
+        raise EmbeddingError(f"Unsupported reply format: {reply_format}.")
+    if reply_dtype not in RAW_DTYPE_CODES:
+        raise EmbeddingError(f"Unsupported reply dtype: {reply_dtype}.")
+    return (sentences, reply_format, reply_dtype)
+
+
+def encode_raw_reply(
+    embedding: np.ndarray, reply_dtype: str = "float32"
+) -> tuple[bytes, memoryview]:
+    dtype_code = RAW_DTYPE_CODES[reply_dtype]
+    matrix = np.ascontiguousarray(embedding, dtype=RAW_DTYPES[dtype_code])
+    if matrix.ndim != 2:
+        matrix = matrix.reshape(len(matrix), -1)
+    header = RAW_HEADER.pack(RAW_MAGIC, dtype_code, matrix.shape[0], matrix.shape[1])
+    return (header, memoryview(matrix).cast("B"))
+
+
+def encode_npy_reply(embedding: np.ndarray) -> bytes:
+    buffer = BytesIO()
+    np.save(buffer, embedding)
+    return buffer.getvalue()
+
+
+def read_raw_embeddings(
+    header: bytes, readinto: Callable[[memoryview], int | None]
+) -> np.ndarray:
+    magic, dtype_code, rows, columns = RAW_HEADER.unpack(header)
+    if magic != RAW_MAGIC or dtype_code not in RAW_DTYPES:
+        raise EmbeddingError("Malformed raw embedding header.")
+    embeddings = np.empty((rows, columns), dtype=RAW_DTYPES[dtype_code])
+    if embeddings.nbytes and not read_into(readinto, memoryview(embeddings).cast("B")):
+        raise EmbeddingError("Embedding reply ended before all rows were recieved.")
+    return embeddings
+
+
+def send_embedding_request(sentences: list[str], medium: IOBase):
+    if medium.readable():
+        logger.error("Medium must be write only..")
+        return False
+    if any([not x for x in sentences]):
+        logger.warning("Cannot embed empty text.")
+        return False
+
+    pickle.dump(sentences, medium)
+    return True
+
+
+def recieve_embeddings(recieve_file: BufferedReader) -> np.ndarray:
+    if recieve_file.writable():
+        logger.error("Recieve file must be read only.")
+        return np.ndarray((1,))
+    header = bytearray(RAW_HEADER.size)
+    view = memoryview(header)
+    received = recieve_file.readinto(view) or 0
+    if received == RAW_HEADER.size and header.startswith(RAW_MAGIC):
+        return read_raw_embeddings(bytes(header), recieve_file.readinto)
+    buffer = BytesIO(bytes(view[:received]) + recieve_file.read())
+    buffer.seek(0)
+    return np.load(buffer)
+
+
+def _validate_embeddings(
+    sentences: list[str], embeddings: np.ndarray
+) -> np.ndarray | None:
+    if embeddings.ndim != 2 or len(embeddings) != len(sentences):
+        logger.error(
+            f"Expected {len(sentences)} embeddings but recieved shape {embeddings.shape}."
+        )
+        return None
+    return embeddings
+
+
+class FifoEmbeddingClient:
+    def __init__(self, request_file: str, recieve_file: str) -> None:
+        self._request_file = request_file
+        self._recieve_file = recieve_file
+        self._lock = Lock()
+
+    def embed(self, sentences: list[str]) -> np.ndarray | None:
+        with self._lock:
+            with open(self._request_file, "wb") as fs:
+                if not send_embedding_request(sentences, fs):
+                    return None
+            with open(self._recieve_file, "rb") as fd:
+                embeddings = recieve_embeddings(fd)
+        return _validate_embeddings(sentences, embeddings)
+
+    def close(self):
+        pass
+
+
+class SocketEmbeddingClient:
+    def __init__(
+        self,
+        socket_path: str,
+        timeout: float | None = None,
+        reply_format: str = "raw",
+        reply_dtype: str = "float32",
+    ) -> None:
+        self._socket_path = socket_path
+        self._timeout = timeout
+        self._reply_format = reply_format
+        self._reply_dtype = reply_dtype
+        self._socket: socket.socket | None = None
+        self._request_ids = count(1)
+        self._lock = Lock()
+
+    def _connect(self) -> socket.socket:
+        if self._socket is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self._timeout)
+            sock.connect(self._socket_path)
+            self._socket = sock
+        return self._socket
+
+    def _request(self, sentences: list[str]) -> np.ndarray:
+        sock = self._connect()
+        request_id = next(self._request_ids)
+        send_frame(
+            sock,
+            request_id,
+            REQUEST_FRAME,
+            encode_request(sentences, self._reply_format, self._reply_dtype),
+        )
+
+        header = read_frame_header(sock)
+        if header is None:
+            raise ConnectionError("Embedding server closed the connection.")
+        reply_id, kind, length = header
+        if reply_id != request_id:
+            raise EmbeddingError(
+                f"Recieved reply for request {reply_id} while waiting for {request_id}."
+            )
+        if kind == REPLY_FRAME and self._reply_format == "raw":
+            raw_header = read_exact(sock, RAW_HEADER.size)
+            if raw_header is None:
+                raise ConnectionError("Embedding server closed the connection.")
+            return read_raw_embeddings(raw_header, sock.recv_into)
+
+        payload = read_exact(sock, length)
+        if payload is None:
+            raise ConnectionError("Embedding server closed the connection.")
+        if kind == ERROR_FRAME:
+            raise EmbeddingError(payload.decode("utf-8", errors="replace"))
+        return np.load(BytesIO(payload))
+
+    def embed(self, sentences: list[str]) -> np.ndarray | None:
+        if any([not x for x in sentences]):
+            logger.warning("Cannot embed empty text.")
+            return None
+
+        with self._lock:
+            try:
+                embeddings = self._request(sentences)
+            except (OSError, ValueError, EmbeddingError) as e:
+                logger.error(f"Embedding request failed: {e}")
+                self.close()
+                return None
+        return _validate_embeddings(sentences, embeddings)
+
+    def stats(self) -> dict[str, object] | None:
+        with self._lock:
+            try:
+                sock = self._connect()
+                request_id = next(self._request_ids)
+                send_frame(sock, request_id, STATS_FRAME)
+                frame = read_frame(sock)
+                if frame is None:
+                    raise ConnectionError("Embedding server closed the connection.")
+            except OSError as e:
+                logger.error(f"Stats request failed: {e}")
+                self.close()
+                return None
+        _, kind, payload = frame
+        if kind == ERROR_FRAME:
+            logger.error(payload.decode("utf-8", errors="replace"))
+            return None
+        return json.loads(payload)
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+class CachedEmbeddingClient:
+    def __init__(
+        self, client: FifoEmbeddingClient | SocketEmbeddingClient, cache: EmbeddingCache
+    ) -> None:
+        self.client = client
+        self.cache = cache
+
+    def embed(self, sentences: list[str]) -> np.ndarray | None:
+        if any([not x for x in sentences]):
+            logger.warning("Cannot embed empty text.")
+            return None
+
+        keys = [self.cache.key(sentence) for sentence in sentences]
+        vectors = self.cache.get_many(keys)
+
+        missing: dict[str, str] = {}
+        for key, sentence, vector in zip(keys, sentences, vectors):
+            if vector is None and key not in missing:
+                missing[key] = sentence
+
+        if missing:
+            embedded = self.client.embed(list(missing.values()))
+            if embedded is None:
+                return None
+            self.cache.put_many(list(missing), embedded)
+            fresh = dict(zip(missing, embedded))
+            vectors = [
+                fresh[key] if vector is None else vector
+                for key, vector in zip(keys, vectors)
+            ]
+
+        return np.stack(vectors).astype(np.float32, copy=False)
+
+    def close(self):
+        self.client.close()
+        self.cache.close()
+
+
+EmbeddingClient = FifoEmbeddingClient | SocketEmbeddingClient | CachedEmbeddingClient
+
+
+def create_embedding_client(
+    socket_path: str | None = None,
+    request_file: str | None = None,
+    recieve_file: str | None = None,
+    reply_format: str = "raw",
+    reply_dtype: str = "float32",
+    cache: EmbeddingCache | None = None,
+) -> EmbeddingClient:
+    if socket_path:
+        client = SocketEmbeddingClient(
+            socket_path, reply_format=reply_format, reply_dtype=reply_dtype
+        )
+    elif request_file and recieve_file:
+        client = FifoEmbeddingClient(request_file, recieve_file)
+    else:
+        raise ValueError(
+            "Either a socket path or both request and recieve files must be provided."
+        )
+
+    if cache is not None:
+        return CachedEmbeddingClient(client, cache)
+    return client
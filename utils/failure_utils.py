@@ -0,0 +1,101 @@
+from datetime import datetime, timezone
+from threading import Lock
+import json
+import logging
+import os
+
+from utils.logging_utils import ColouredLogger
+
+logger: ColouredLogger = logging.getLogger(__name__)
+
+RESOLVED_STAGE = "resolved"
+
+
+class FailureLog:
+    """
+    Append-only JSONL log of documents that could not be indexed.
+
+    Every failure is written as its own record with the stage it failed in and
+    how many times the document has failed so far. A later "resolved" record
+    marks the document as indexed again.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = Lock()
+        self.attempts: dict[str, int] = {}
+        self.pending: dict[str, dict[str, object]] = {}
+        if os.path.isfile(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line_number, line in enumerate(f, 1):
+                try:
+                    record = json.loads(line)
+                    doc_id = record["id"]
+                    stage = record["stage"]
+                except (ValueError, KeyError, TypeError):
+                    logger.warning(
+                        f"Skipping malformed line {line_number} of failure log '{self.path}'."
+                    )
+                    continue
+                if stage == RESOLVED_STAGE:
+                    self.pending.pop(doc_id, None)
+                else:
+                    self.attempts[doc_id] = max(
+                        self.attempts.get(doc_id, 0), int(record.get("attempt", 1))
+                    )
+                    self.pending[doc_id] = record
+
+    def _append(self, records: list[dict[str, object]]):
+        if not records:
+            return
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def record(self, doc_ids: list[str], stage: str, error: str):
+        now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        with self._lock:
+            records = []
+            for doc_id in doc_ids:
+                attempt = self.attempts.get(doc_id, 0) + 1
+                self.attempts[doc_id] = attempt
+                record = {
+                    "id": doc_id,
+                    "stage": stage,
+                    "error": error,
+                    "attempt": attempt,
+                    "time": now,
+                }
+                self.pending[doc_id] = record
+                records.append(record)
+            self._append(records)
+
+    def resolve(self, doc_ids: list[str]):
+        now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        with self._lock:
+            records = []
+            for doc_id in doc_ids:
+                if self.pending.pop(doc_id, None) is not None:
+                    records.append(
+                        {
+                            "id": doc_id,
+                            "stage": RESOLVED_STAGE,
+                            "error": None,
+                            "attempt": self.attempts.get(doc_id, 0),
+                            "time": now,
+                        }
+                    )
+            self._append(records)
+
+    def pending_ids(self, max_attempts: int = 0) -> list[str]:
+        with self._lock:
+            return [
+                doc_id
+                for doc_id in self.pending
+                if max_attempts <= 0 or self.attempts.get(doc_id, 0) < max_attempts
+            ]
@@ -0,0 +1,208 @@
+import json
+import logging
+import os
+
+import numpy as np
+
+from utils.logging_utils import ColouredLogger
+
+logger: ColouredLogger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+VECTORS_FILE = "vectors.bin"
+IDS_FILE = "ids.npy"
+CENTROIDS_FILE = "centroids.npy"
+LIST_OFFSETS_FILE = "list_offsets.npy"
+LIST_ROWS_FILE = "list_rows.npy"
+INDEX_DTYPES = ("float32", "float16")
+
+# Rows scored per matrix product, so exact search never loads the whole
+# memory-mapped matrix at once.
+SEARCH_CHUNK_ROWS = 65_536
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    if k >= len(scores):
+        return np.argsort(-scores, kind="stable")
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def train_ivf(
+    vectors: np.ndarray,
+    nlist: int,
+    iterations: int = 10,
+    sample_size: int = 100_000,
+    seed: int = 0,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Clusters the normalized vectors with spherical k-means and groups the row
+    numbers of every cluster into one contiguous inverted list.
+    """
+    rng = np.random.default_rng(seed)
+    count = len(vectors)
+    nlist = min(nlist, count)
+    sample_rows = np.sort(rng.choice(count, min(sample_size, count), replace=False))
+    sample = np.asarray(vectors[sample_rows], dtype=np.float32)
+    if nlist > len(sample):
+        logger.warning(
+            f"Cannot train {nlist} lists from a sample of {len(sample)} vectors. Training {len(sample)} lists instead."
+        )
+        nlist = len(sample)
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        empty = np.bincount(assignments, minlength=nlist) == 0
+        sums[empty] = centroids[empty]
+        centroids = normalize_rows(sums)
+
+    assignments = np.empty(count, dtype=np.int64)
+    for start in range(0, count, SEARCH_CHUNK_ROWS):
+        chunk = np.asarray(vectors[start : start + SEARCH_CHUNK_ROWS], np.float32)
+        assignments[start : start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+
+    list_rows = np.argsort(assignments, kind="stable")
+    list_offsets = np.searchsorted(assignments[list_rows], np.arange(nlist + 1))
+    return (centroids, list_offsets.astype(np.int64), list_rows.astype(np.int64))
+
+
+class VectorIndexWriter:
+    """
+    Writes normalized vectors into an index directory as they arrive. The
+    manifest is written last, so an index without one is incomplete.
+    """
+
+    def __init__(self, path: str, dtype: str = "float32") -> None:
+        if dtype not in INDEX_DTYPES:
+            raise ValueError(f"Unsupported index dtype: {dtype}.")
+        os.makedirs(path, exist_ok=True)
+        manifest = os.path.join(path, MANIFEST_FILE)
+        if os.path.exists(manifest):
+            os.remove(manifest)
+        self.path = path
+        self.dtype = dtype
+        self.dimensions: int | None = None
+        self._ids: list[str] = []
+        self._vectors = open(os.path.join(path, VECTORS_FILE), "wb")
+
+    def add(self, ids: list[str], vectors: np.ndarray):
+        matrix = normalize_rows(vectors)
+        if self.dimensions is None:
+            self.dimensions = matrix.shape[1]
+        elif matrix.shape[1] != self.dimensions:
+            raise ValueError(
+                f"Expected vectors with {self.dimensions} dimensions but recieved {matrix.shape[1]}."
+            )
+        if len(ids) != len(matrix):
+            raise ValueError(f"Recieved {len(ids)} ids for {len(matrix)} vectors.")
+        self._vectors.write(matrix.astype(self.dtype).tobytes())
+        self._ids.extend(ids)
+
+    def close(self, nlist: int = 0, iterations: int = 10, sample_size: int = 100_000):
+        self._vectors.close()
+        count = len(self._ids)
+        np.save(os.path.join(self.path, IDS_FILE), np.array(self._ids, dtype=str))
+
+        manifest = {
+            "count": count,
+            "dimensions": self.dimensions or 0,
+            "dtype": self.dtype,
+            "metric": "cosine",
+            "nlist": 0,
+        }
+        if nlist > 0 and count:
+            vectors = np.memmap(
+                os.path.join(self.path, VECTORS_FILE),
+                dtype=self.dtype,
+                mode="r",
+                shape=(count, self.dimensions),
+            )
+            logger.info(f"Training IVF lists over {count} vectors...")
+            centroids, list_offsets, list_rows = train_ivf(
+                vectors, nlist, iterations, sample_size
+            )
+            np.save(os.path.join(self.path, CENTROIDS_FILE), centroids)
+            np.save(os.path.join(self.path, LIST_OFFSETS_FILE), list_offsets)
+            np.save(os.path.join(self.path, LIST_ROWS_FILE), list_rows)
+            manifest["nlist"] = len(centroids)
+
+        temp_path = os.path.join(self.path, f"{MANIFEST_FILE}.tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(temp_path, os.path.join(self.path, MANIFEST_FILE))
+        return manifest
+
+
+class VectorIndex:
+    """
+    Memory-mapped cosine similarity index. Searches are exact unless nprobe is
+    given, in which case only the nprobe closest IVF lists are scored.
+    """
+
+    def __init__(self, path: str) -> None:
+        with open(os.path.join(path, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            self.manifest: dict[str, object] = json.load(f)
+        self.count = int(self.manifest["count"])
+        self.dimensions = int(self.manifest["dimensions"])
+        self.vectors = np.empty((0, self.dimensions), dtype=str(self.manifest["dtype"]))
+        if self.count:
+            self.vectors = np.memmap(
+                os.path.join(path, VECTORS_FILE),
+                dtype=str(self.manifest["dtype"]),
+                mode="r",
+                shape=(self.count, self.dimensions),
+            )
+        self.ids = np.load(os.path.join(path, IDS_FILE), mmap_mode="r")
+
+        self.centroids: np.ndarray | None = None
+        if int(self.manifest.get("nlist", 0)) > 0:
+            self.centroids = np.load(os.path.join(path, CENTROIDS_FILE))
+            self.list_offsets = np.load(os.path.join(path, LIST_OFFSETS_FILE))
+            self.list_rows = np.load(os.path.join(path, LIST_ROWS_FILE), mmap_mode="r")
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _candidate_rows(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        lists = top_k(self.centroids @ query, nprobe)
+        rows = np.concatenate(
+            [
+                self.list_rows[self.list_offsets[i] : self.list_offsets[i + 1]]
+                for i in lists
+            ]
+        )
+        # Sorted rows turn the gather into mostly sequential reads of the map.
+        return np.sort(rows)
+
+    def search(
+        self, query: np.ndarray, k: int, nprobe: int = 0
+    ) -> tuple[list[str], np.ndarray]:
+        query = normalize_rows(query)[0]
+        if nprobe > 0 and self.centroids is not None:
+            rows = self._candidate_rows(query, nprobe)
+            scores = np.asarray(self.vectors[rows], dtype=np.float32) @ query
+            best = top_k(scores, k)
+            rows, scores = rows[best], scores[best]
+        else:
+            rows = np.empty(0, dtype=np.int64)
+            scores = np.empty(0, dtype=np.float32)
+            for start in range(0, self.count, SEARCH_CHUNK_ROWS):
+                chunk = np.asarray(
+                    self.vectors[start : start + SEARCH_CHUNK_ROWS], dtype=np.float32
+                )
+                rows = np.concatenate([rows, np.arange(start, start + len(chunk))])
+                scores = np.concatenate([scores, chunk @ query])
+                best = top_k(scores, k)
+                rows, scores = rows[best], scores[best]
+        return ([str(self.ids[row]) for row in rows], scores)
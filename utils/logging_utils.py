@@ -1,14 +1,25 @@
 import logging
 from logging import INFO, DEBUG, ERROR, WARNING, CRITICAL
-from logging.handlers import TimedRotatingFileHandler, RotatingFileHandler
+from logging.handlers import (
+    QueueHandler,
+    QueueListener,
+    TimedRotatingFileHandler,
+    RotatingFileHandler,
+)
+from concurrent.futures import ThreadPoolExecutor
+from queue import SimpleQueue
+import atexit
 import os
 import sys
 import datetime
 import gzip
 import shutil
+import time
 from enum import Enum
 import re
 
+PENDING_SUFFIX = ".pending"
+
 
 class RotationType(Enum):
     TIMED = 1
@@ -23,6 +34,46 @@ class RotationIntervalUnit(Enum):
     MIDNIGHT = "midnight"
 
 
+class LogSampler:
+    """
+    Decides which of many similar messages get logged. A call is let through
+    when `every` calls have passed since the last logged one, or `interval`
+    seconds have, whichever comes first. `suppressed` counts the calls
+    skipped since then.
+    """
+
+    def __init__(self, every: int = 1, interval: float = 0) -> None:
+        self.every = max(every, 1)
+        self.interval = interval
+        self.suppressed = 0
+        self._last_logged = float("-inf")
+
+    def __call__(self) -> bool:
+        if self.suppressed + 1 >= self.every:
+            return self._logged()
+        if self.interval > 0 and time.monotonic() - self._last_logged >= self.interval:
+            return self._logged()
+        self.suppressed += 1
+        return False
+
+    def _logged(self) -> bool:
+        self.suppressed = 0
+        self._last_logged = time.monotonic()
+        return True
+
+
+class _RecordQueueHandler(QueueHandler):
+    """
+    Only merges the message arguments on the logging thread. Records stay in
+    process, so formatting and exception rendering are left to the listener.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
 class ColouredLogger(logging.Logger):
     _level_color = {
         10: 36,
@@ -32,16 +83,31 @@ class ColouredLogger(logging.Logger):
         50: 31,
     }
 
+    _compressor: ThreadPoolExecutor | None = None
+    _listener: QueueListener | None = None
+
     def __init__(self, name: str) -> None:
         super().__init__(name)
         self.mode = "stream"
 
-    def _rotator(self, source, dest):
+    @staticmethod
+    def _compress(source: str, dest: str):
         with open(source, "rb") as f_in:
             with gzip.open(f"{dest}.gz", "wb") as f_out:
                 shutil.copyfileobj(f_in, f_out)
         os.remove(source)
 
+    def _rotator(self, source, dest):
+        # Only the rename happens while the handler holds its lock. Compressing
+        # is left to a background thread so rotation doesn't stall logging.
+        pending = f"{dest}{PENDING_SUFFIX}"
+        os.rename(source, pending)
+        if ColouredLogger._compressor is None:
+            ColouredLogger._compressor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="LogCompressor"
+            )
+        ColouredLogger._compressor.submit(self._compress, pending, dest)
+
     def _timed_filer(self, default_name):
         now = datetime.datetime.now()
         folder_name = f'{os.path.dirname(self.logging_path)}/{now.strftime("%Y")}/{now.strftime("%Y-%m")}'
@@ -51,14 +117,24 @@ class ColouredLogger(logging.Logger):
         return f"{folder_name}/{base_name}"
 
     def _sized_filer(self, default_name: str):
+        base_name: str = os.path.basename(default_name)
+        base_name, counter = base_name.rsplit(".", 1)
+        if counter != "1":
+            # Rollover asks for every backup name to shift them along, which
+            # this scheme never does. Only ".1" names the file being rotated.
+            return default_name
         now = datetime.datetime.now()
         folder_name = f'{os.path.dirname(self.logging_path)}/{now.strftime("%Y")}/{now.strftime("%Y-%m")}'
         if not os.path.isdir(folder_name):
             os.makedirs(folder_name)
-        base_name: str = os.path.basename(default_name)
-        base_name, counter = base_name.rsplit(".", 1)
-        counter = len(os.listdir(folder_name))
-        return f"{folder_name}/{base_name}.{int(counter) + 1}"
+        # Numbered after the highest existing file, as files still waiting to
+        # be compressed would make a plain count reuse a name.
+        pattern = re.compile(
+            rf"^{re.escape(base_name)}\.(\d+)(?:\.gz|{re.escape(PENDING_SUFFIX)})?$"
+        )
+        found = [pattern.match(name) for name in os.listdir(folder_name)]
+        counter = max([int(match.group(1)) for match in found if match], default=0)
+        return f"{folder_name}/{base_name}.{counter + 1}"
 
     def _expression_to_bytes(self, expression: str):
         found = re.match(r"^(\d+)(?=M|G|$)(M|G|)$", expression)
@@ -82,8 +158,10 @@ class ColouredLogger(logging.Logger):
         rotation_interval_unit=RotationIntervalUnit.MIDNIGHT.value,
         rotation_interval=5,
         log_max_size="100M",
+        async_logging=False,
     ):
         logging_level = logging.INFO if not debug else logging.DEBUG
+        logging.getLogger().setLevel(logging_level)
         logging_formatter = logging.Formatter(
             fmt="%(asctime)s %(threadName)s %(name)s %(module)s #%(lineno)d %(levelname)s %(message)s",
             datefmt="%Y-%m-%d %H:%M:%S",
@@ -93,7 +171,7 @@ class ColouredLogger(logging.Logger):
             stream_handler = logging.StreamHandler()
             stream_handler.setFormatter(logging_formatter)
             stream_handler.setLevel(logging_level)
-            logging.getLogger().addHandler(stream_handler)
+            self._add_handler(stream_handler, async_logging)
             logging.getLogger().mode = "stream"
         else:
             if not os.path.isdir(os.path.dirname(logging_path)):
@@ -118,18 +196,63 @@ class ColouredLogger(logging.Logger):
                 file_handler.rotator = self._rotator
             file_handler.setFormatter(logging_formatter)
             file_handler.setLevel(logging_level)
-            logging.getLogger().addHandler(file_handler)
+            self._add_handler(file_handler, async_logging)
             logging.getLogger().mode = "file"
 
+    def _add_handler(self, handler: logging.Handler, async_logging: bool):
+        """
+        Attaches the handler to the root logger, or with async logging behind a
+        queue drained by a listener thread, so callers never wait on I/O.
+        """
+        if not async_logging:
+            logging.getLogger().addHandler(handler)
+            return
+
+        queue_handler = _RecordQueueHandler(SimpleQueue())
+        logging.getLogger().addHandler(queue_handler)
+        self._start_listener(queue_handler, handler)
+        atexit.register(ColouredLogger.stop_async_logging)
+        os.register_at_fork(
+            after_in_child=lambda: self._start_listener(
+                queue_handler, handler, SimpleQueue()
+            )
+        )
+
+    @staticmethod
+    def _start_listener(
+        queue_handler: QueueHandler,
+        handler: logging.Handler,
+        queue: SimpleQueue | None = None,
+    ):
+        # Listener threads don't survive a fork, so children drain a new queue.
+        if queue is not None:
+            queue_handler.queue = queue
+        ColouredLogger._listener = QueueListener(
+            queue_handler.queue, handler, respect_handler_level=True
+        )
+        ColouredLogger._listener.start()
+
+    @staticmethod
+    def stop_async_logging():
+        """Writes out queued records and waits for pending log compressions."""
+        if ColouredLogger._listener is not None:
+            ColouredLogger._listener.stop()
+            ColouredLogger._listener = None
+        if ColouredLogger._compressor is not None:
+            ColouredLogger._compressor.shutdown(wait=True)
+            ColouredLogger._compressor = None
+
     def _log_with_color(self, level: int, message: str):
-        if logging.getLogger().mode is None or logging.getLogger().mode == "file":
+        mode = getattr(logging.getLogger(), "mode", None)
+        if mode is None or mode == "file":
             return message
         return f"\033[{self._level_color[level]}m{message}\033[0m"
 
     def info(self, msg, *args, **kwargs):
+        if not self.isEnabledFor(INFO):
+            return
         if "stack_level" in kwargs:
             stack_level = kwargs.pop("stack_level")
-            kwargs.pop("stack_level")
         else:
             stack_level = 2
         self._log(
@@ -141,6 +264,8 @@ class ColouredLogger(logging.Logger):
         )
 
     def debug(self, msg, *args, **kwargs):
+        if not self.isEnabledFor(DEBUG):
+            return
         if "stack_level" in kwargs:
             stack_level = kwargs.pop("stack_level")
         else:
@@ -154,6 +279,8 @@ class ColouredLogger(logging.Logger):
         )
 
     def warning(self, msg, *args, **kwargs):
+        if not self.isEnabledFor(WARNING):
+            return
         if "stack_level" in kwargs:
             stack_level = kwargs.pop("stack_level")
         else:
@@ -167,6 +294,8 @@ class ColouredLogger(logging.Logger):
         )
 
     def error(self, msg, *args, **kwargs):
+        if not self.isEnabledFor(ERROR):
+            return
         if "stack_level" in kwargs:
             stack_level = kwargs.pop("stack_level")
         else:
@@ -180,6 +309,8 @@ class ColouredLogger(logging.Logger):
         )
 
     def critical(self, msg, *args, **kwargs):
+        if not self.isEnabledFor(CRITICAL):
+            return
         if "stack_level" in kwargs:
             stack_level = kwargs.pop("stack_level")
         else:
@@ -0,0 +1,342 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Lock, Thread
+from typing import Callable, Iterator
+import json
+import logging
+import math
+import os
+import time
+
+from utils.logging_utils import ColouredLogger
+
+logger: ColouredLogger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+RATIO_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0)
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        self._lock = Lock()
+        self._value = 0.0
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        self._lock = Lock()
+        self._value = 0.0
+        self._function: Callable[[], float] | None = None
+
+    def set(self, value: float):
+        with self._lock:
+            self._value = value
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+    def set_function(self, function: Callable[[], float] | None):
+        """Reads the gauge from function whenever it is collected instead."""
+        self._function = function
+
+    @property
+    def value(self) -> float:
+        if self._function is not None:
+            try:
+                return float(self._function())
+            except Exception as e:
+                logger.debug(f"Could not collect gauge {self.name}: {e}")
+                return math.nan
+        return self._value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help: str, buckets: tuple[float, ...] = LATENCY_BUCKETS
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self._lock = Lock()
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        index = next(
+            (i for i, bound in enumerate(self.buckets) if value <= bound),
+            len(self.buckets),
+        )
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def cumulative(self) -> tuple[list[tuple[str, int]], int, float]:
+        with self._lock:
+            counts, count, total = list(self._counts), self.count, self.sum
+        running = 0
+        buckets = []
+        for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+            running += bucket_count
+            buckets.append(("+Inf" if bound == math.inf else f"{bound:g}", running))
+        return (buckets, count, total)
+
+    def quantile(self, buckets: list[tuple[str, int]], count: int, q: float):
+        """Estimates a quantile by interpolating inside its bucket, like Prometheus."""
+        if not count:
+            return None
+        rank = q * count
+        lower, previous = 0.0, 0
+        for (bound, cumulative), upper in zip(buckets, self.buckets + (math.inf,)):
+            if cumulative >= rank:
+                if upper == math.inf:
+                    return lower
+                share = (rank - previous) / (cumulative - previous)
+                return lower + (upper - lower) * share
+            lower, previous = upper, cumulative
+        return lower
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._metrics: dict[str, Counter | Gauge | Histogram] = {}
+        self.started = time.time()
+
+    def _get(self, cls, name: str, *args):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args)
+            elif not isinstance(metric, cls):
+                raise ValueError(
+                    f"Metric {name} is already registered as a {metric.kind}."
+                )
+            return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._get(Counter, name, help)
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self._get(Gauge, name, help)
+
+    def histogram(
+        self, name: str, help: str, buckets: tuple[float, ...] = LATENCY_BUCKETS
+    ) -> Histogram:
+        return self._get(Histogram, name, help, buckets)
+
+    def metrics(self) -> list[Counter | Gauge | Histogram]:
+        with self._lock:
+            return list(self._metrics.values())
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for metric in self.metrics():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            if isinstance(metric, Histogram):
+                buckets, count, total = metric.cumulative()
+                for bound, cumulative in buckets:
+                    lines.append(f'{metric.name}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f"{metric.name}_sum {total:g}")
+                lines.append(f"{metric.name}_count {count}")
+            else:
+                lines.append(f"{metric.name} {metric.value:g}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict[str, object]:
+        now = time.time()
+        snapshot = {
+            "time": now,
+            "uptime_seconds": now - self.started,
+            "counters": {},
+            "gauges": {},
+            "histograms": {},
+        }
+        for metric in self.metrics():
+            if isinstance(metric, Histogram):
+                buckets, count, total = metric.cumulative()
+                snapshot["histograms"][metric.name] = {
+                    "count": count,
+                    "sum": total,
+                    "mean": total / count if count else None,
+                    "p50": metric.quantile(buckets, count, 0.5),
+                    "p95": metric.quantile(buckets, count, 0.95),
+                    "p99": metric.quantile(buckets, count, 0.99),
+                    "buckets": dict(buckets),
+                }
+            elif isinstance(metric, Counter):
+                snapshot["counters"][metric.name] = metric.value
+            else:
+                value = metric.value
+                snapshot["gauges"][metric.name] = None if math.isnan(value) else value
+        return snapshot
+
+
+registry = MetricsRegistry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    server: "MetricsServer"
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/metrics":
+            body = self.server.registry.render_prometheus().encode("utf-8")
+            content_type = PROMETHEUS_CONTENT_TYPE
+        elif path == "/metrics.json":
+            body = json.dumps(self.server.registry.snapshot()).encode("utf-8")
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args):
+        logger.debug(f"Metrics request: {format % args}")
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """Serves /metrics in the Prometheus text format and /metrics.json on a daemon thread."""
+
+    daemon_threads = True
+
+    def __init__(
+        self, port: int, host: str = "", metrics: MetricsRegistry = registry
+    ) -> None:
+        self.registry = metrics
+        super().__init__((host, port), _MetricsHandler)
+        self._thread = Thread(
+            target=self.serve_forever, name="MetricsServer", daemon=True
+        )
+        self._thread.start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class SnapshotWriter:
+    """
+    Periodically replaces path with a JSON snapshot of the registry. Counter
+    rates are computed over the interval since the previous snapshot.
+    """
+
+    def __init__(
+        self, path: str, interval: float = 10, metrics: MetricsRegistry = registry
+    ) -> None:
+        self.path = path
+        self.interval = interval
+        self.registry = metrics
+        self._previous: dict[str, object] | None = None
+        self._stop = Event()
+        self._thread = Thread(target=self._run, name="MetricsSnapshot", daemon=True)
+        self._thread.start()
+
+    def write(self):
+        snapshot = self.registry.snapshot()
+        previous = self._previous
+        if previous is not None and snapshot["time"] > previous["time"]:
+            elapsed = snapshot["time"] - previous["time"]
+            snapshot["rates"] = {
+                name: (value - previous["counters"].get(name, 0)) / elapsed
+                for name, value in snapshot["counters"].items()
+            }
+        else:
+            snapshot["rates"] = {
+                name: value / snapshot["uptime_seconds"]
+                for name, value in snapshot["counters"].items()
+                if snapshot["uptime_seconds"] > 0
+            }
+        self._previous = snapshot
+
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, indent=4)
+        os.replace(temp_path, self.path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                logger.error(f"Could not write metrics snapshot: {e}")
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.write()
+
+
+def start_metrics(
+    port: int = 0,
+    snapshot_path: str | None = None,
+    interval: float = 10,
+    host: str = "",
+) -> list[MetricsServer | SnapshotWriter]:
+    exporters: list[MetricsServer | SnapshotWriter] = []
+    if port > 0:
+        exporters.append(MetricsServer(port, host))
+        logger.info(f"Serving metrics on port {port} at /metrics and /metrics.json.")
+    if snapshot_path:
+        exporters.append(SnapshotWriter(snapshot_path, interval))
+        logger.info(
+            f"Writing metrics snapshots to '{snapshot_path}' every {interval}s."
+        )
+    return exporters
+
+
+def stop_metrics(exporters: list[MetricsServer | SnapshotWriter]):
+    for exporter in exporters:
+        exporter.close()
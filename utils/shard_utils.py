@@ -0,0 +1,147 @@
+from typing import Iterator
+import json
+import logging
+import os
+
+import numpy as np
+
+from utils.logging_utils import ColouredLogger
+
+logger: ColouredLogger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+SHARD_FORMAT_VERSION = 1
+SHARD_DTYPES = ("float32", "float16")
+
+
+def shard_names(number: int) -> tuple[str, str]:
+    return (f"vectors-{number:05d}.npy", f"ids-{number:05d}.npy")
+
+
+class ShardWriter:
+    """
+    Writes exported vectors into fixed size .npy shards, each paired with an
+    ids shard. The manifest is written last, so an export without one is
+    incomplete.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        vector_field: str,
+        shard_size: int = 100_000,
+        dtype: str = "float32",
+    ) -> None:
+        if dtype not in SHARD_DTYPES:
+            raise ValueError(f"Unsupported shard dtype: {dtype}.")
+        os.makedirs(path, exist_ok=True)
+        manifest = os.path.join(path, MANIFEST_FILE)
+        if os.path.exists(manifest):
+            os.remove(manifest)
+        self.path = path
+        self.vector_field = vector_field
+        self.shard_size = shard_size
+        self.dtype = dtype
+        self.dimensions: int | None = None
+        self.shards: list[dict[str, object]] = []
+        self._ids: list[str] = []
+        self._vectors: list[np.ndarray] = []
+        self._buffered = 0
+
+    def add(self, ids: list[str], vectors: np.ndarray):
+        matrix = np.asarray(vectors, dtype=self.dtype)
+        if self.dimensions is None:
+            self.dimensions = matrix.shape[1]
+        elif matrix.shape[1] != self.dimensions:
+            raise ValueError(
+                f"Expected vectors with {self.dimensions} dimensions but recieved {matrix.shape[1]}."
+            )
+        if len(ids) != len(matrix):
+            raise ValueError(f"Recieved {len(ids)} ids for {len(matrix)} vectors.")
+
+        start = 0
+        while start < len(ids):
+            end = start + self.shard_size - self._buffered
+            self._ids.extend(ids[start:end])
+            self._vectors.append(matrix[start:end])
+            self._buffered += len(matrix[start:end])
+            start = end
+            if self._buffered >= self.shard_size:
+                self._write_shard()
+
+    def _write_shard(self):
+        if not self._buffered:
+            return
+        vectors_name, ids_name = shard_names(len(self.shards))
+        np.save(os.path.join(self.path, vectors_name), np.concatenate(self._vectors))
+        np.save(os.path.join(self.path, ids_name), np.array(self._ids, dtype=str))
+        self.shards.append(
+            {"vectors": vectors_name, "ids": ids_name, "count": self._buffered}
+        )
+        logger.debug(f"Wrote shard {vectors_name} of {self._buffered} vectors.")
+        self._ids, self._vectors, self._buffered = [], [], 0
+
+    def close(self, source: dict[str, object] | None = None) -> dict[str, object]:
+        self._write_shard()
+        manifest = {
+            "version": SHARD_FORMAT_VERSION,
+            "vector_field": self.vector_field,
+            "count": sum(int(shard["count"]) for shard in self.shards),
+            "dimensions": self.dimensions or 0,
+            "dtype": self.dtype,
+            "source": source or {},
+            "shards": self.shards,
+        }
+        temp_path = os.path.join(self.path, f"{MANIFEST_FILE}.tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(temp_path, os.path.join(self.path, MANIFEST_FILE))
+        return manifest
+
+
+class ShardReader:
+    """Reads an export back shard by shard through read-only memory maps."""
+
+    def __init__(self, path: str) -> None:
+        with open(os.path.join(path, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            self.manifest: dict[str, object] = json.load(f)
+        if self.manifest.get("version") != SHARD_FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported export version: {self.manifest.get('version')}."
+            )
+        self.path = path
+        self.count = int(self.manifest["count"])
+        self.dimensions = int(self.manifest["dimensions"])
+        self.vector_field = str(self.manifest["vector_field"])
+        self.shards: list[dict[str, object]] = self.manifest["shards"]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def open_shard(self, shard: dict[str, object]) -> tuple[np.ndarray, np.ndarray]:
+        vectors = np.load(os.path.join(self.path, shard["vectors"]), mmap_mode="r")
+        ids = np.load(os.path.join(self.path, shard["ids"]), mmap_mode="r")
+        if len(vectors) != shard["count"] or len(ids) != shard["count"]:
+            raise ValueError(f"Shard {shard['vectors']} does not match the manifest.")
+        if vectors.ndim != 2 or vectors.shape[1] != self.dimensions:
+            raise ValueError(
+                f"Shard {shard['vectors']} has shape {vectors.shape} but the manifest expects {self.dimensions} dimensions."
+            )
+        return (vectors, ids)
+
+    def batches(
+        self, batch_size: int, skip: int = 0
+    ) -> Iterator[tuple[list[str], np.ndarray]]:
+        """Yields (ids, float32 vectors) batches, starting after the first skip rows."""
+        for shard in self.shards:
+            count = int(shard["count"])
+            if skip >= count:
+                skip -= count
+                continue
+            vectors, ids = self.open_shard(shard)
+            for start in range(skip, count, batch_size):
+                yield (
+                    [str(doc_id) for doc_id in ids[start : start + batch_size]],
+                    np.asarray(vectors[start : start + batch_size], dtype=np.float32),
+                )
+            skip = 0
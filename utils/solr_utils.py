@@ -0,0 +1,689 @@
+from collections import deque
+from io import TextIOWrapper
+from queue import Full, Queue
+from functools import partial
+from threading import Event, Thread
+from typing import Callable
+import json
+import logging
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from utils.logging_utils import ColouredLogger
+from utils.metrics_utils import SIZE_BUCKETS, registry
+from utils.vector_utils import RawJSON
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+logger: ColouredLogger = logging.getLogger(__name__)
+
+ID_SORTS = {"id asc": "asc", "id desc": "desc"}
+
+fetch_seconds = registry.histogram(
+    "solr_fetch_seconds", "Latency of Solr cursor page requests including parsing."
+)
+fetched_documents = registry.counter(
+    "solr_fetched_documents_total", "Documents read from Solr cursors."
+)
+prefetch_queue_depth = registry.gauge(
+    "solr_prefetch_queue_depth", "Solr pages waiting in the prefetch queue."
+)
+update_seconds = registry.histogram(
+    "solr_update_seconds", "Latency of Solr update requests."
+)
+update_batch_documents = registry.histogram(
+    "solr_update_batch_documents",
+    "Documents sent per Solr update request.",
+    SIZE_BUCKETS,
+)
+updated_documents = registry.counter(
+    "solr_updated_documents_total", "Documents updated in Solr."
+)
+failed_documents = registry.counter(
+    "solr_failed_documents_total", "Documents whose Solr update request failed."
+)
+
+
+def id_sort_direction(sort: str) -> str | None:
+    return ID_SORTS.get(" ".join(sort.split()).lower())
+
+
+def id_range_filter(doc_id: str, direction: str) -> str:
+    escaped = doc_id.replace("\\", "\\\\").replace('"', '\\"')
+    if direction == "asc":
+        return f'id:{{"{escaped}" TO *]'
+    return f'id:[* TO "{escaped}"}}'
+
+
+def parse_cursor_page(stream) -> tuple[str | None, list[dict[str, object]]]:
+    next_cursor = None
+    docs = []
+    builder = None
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == "response.docs.item" and event == "end_map":
+                docs.append(builder.value)
+                builder = None
+        elif prefix == "response.docs.item" and event == "start_map":
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+        elif prefix == "nextCursorMark":
+            next_cursor = value
+    return (next_cursor, docs)
+
+
+def create_session(
+    pool_size: int = 10, max_retries: int = 3, retry_backoff: float = 0.5
+) -> requests.Session:
+    retry = Retry(
+        total=max_retries,
+        connect=max_retries,
+        read=max_retries,
+        status=max_retries,
+        backoff_factor=retry_backoff,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=None,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["Connection"] = "keep-alive"
+    return session
+
+
+class Solr:
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        collection: str,
+        pool_size: int = 10,
+        max_retries: int = 3,
+        retry_backoff: float = 0.5,
+        timeout: float | None = 60,
+    ) -> None:
+        self._host = host
+        self._port = port
+        self._collection = collection
+        self._uri = f"http://{host}:{port}/solr/{collection}"
+        self._timeout = timeout
+        self.session = create_session(pool_size, max_retries, retry_backoff)
+
+    def close(self):
+        self.session.close()
+
+    class _Cursor:
+        def __init__(
+            self,
+            solr,
+            q,
+            buffer_size,
+            cursor,
+            sort,
+            total_scrolled,
+            fq=None,
+            fl=None,
+            stream_parse=False,
+            after_id=None,
+            skip=0,
+        ) -> None:
+            self._solr: Solr = solr
+            self._fq: list[str] = list(fq or [])
+            self._fl: list[str] = list(fl or [])
+            if stream_parse and ijson is None:
+                logger.warning(
+                    "ijson is not installed. Falling back to parsing whole pages."
+                )
+            self._stream_parse = stream_parse and ijson is not None
+            self._uri = solr._uri
+            self._doc_buffer: deque[dict[str, object]] = deque()
+            self._q = q
+            self._buffer_size = buffer_size
+            self._cursor = cursor
+            self._sort = sort
+            self._after_id: str | None = after_id
+            self._skip = skip
+            self._page_size = 0
+            self.page_mark = cursor
+            self.page_offset = -1
+            self.total_scrolled = total_scrolled
+            self.failed = False
+            self.resumed_from: dict[str, object] | None = None
+
+        def __iter__(self):
+            return self
+
+        def __next__(self) -> dict[str, object]:
+            while not self._doc_buffer:
+                page = self._next_page()
+                if page is None:
+                    raise StopIteration()
+
+                self.page_mark, self._cursor, docs = page
+                self._page_size = len(docs)
+                self._doc_buffer.extend(docs[self._skip :])
+                self._skip = 0
+
+            self.total_scrolled += 1
+            self.page_offset = self._page_size - len(self._doc_buffer)
+            return self._doc_buffer.popleft()
+
+        def _next_page(self):
+            return self._fetch_page(self._cursor)
+
+        def _fetch_page(
+            self, cursor_mark: str
+        ) -> tuple[str, str, list[dict[str, object]]] | None:
+            logger.debug(
+                f"Buffer ran out of documents. Requesting {self._buffer_size} more documents..."
+            )
+            params = {
+                "q": self._q,
+                "rows": self._buffer_size,
+                "cursorMark": cursor_mark,
+                "sort": self._sort,
+                "wt": "json",
+                "omitHeader": "true",
+            }
+            fq = list(self._fq)
+            direction = id_sort_direction(self._sort)
+            if self._after_id is not None and direction is not None:
+                fq.append(id_range_filter(self._after_id, direction))
+            if fq:
+                params["fq"] = fq
+            if self._fl:
+                params["fl"] = ",".join(self._fl)
+            started = time.perf_counter()
+            try:
+                response = self._solr.session.get(
+                    f"{self._uri}/select",
+                    params=params,
+                    timeout=self._solr._timeout,
+                    stream=self._stream_parse,
+                )
+                if response.status_code != 200:
+                    self.failed = True
+                    logger.error(
+                        f"Failed to fetch documents from solr. Status: {response.status_code}. Response: {response.text}"
+                    )
+                    return None
+
+                if self._stream_parse:
+                    with response:
+                        response.raw.decode_content = True
+                        next_cursor, docs = parse_cursor_page(response.raw)
+                else:
+                    result = response.json()
+                    next_cursor = result["nextCursorMark"]
+                    docs = result["response"]["docs"]
+            except requests.RequestException as e:
+                self.failed = True
+                logger.error(f"Failed to fetch documents from solr: {e}")
+                return None
+            fetch_seconds.observe(time.perf_counter() - started)
+            fetched_documents.inc(len(docs))
+
+            if next_cursor is None or next_cursor == cursor_mark or not docs:
+                return None
+
+            return (cursor_mark, next_cursor, docs)
+
+        def reset(self):
+            self._doc_buffer = deque()
+            self._cursor = "*"
+            self._after_id = None
+            self._skip = 0
+            self._page_size = 0
+            self.page_mark = "*"
+            self.page_offset = -1
+            self.total_scrolled = 0
+            self.failed = False
+            self.resumed_from = None
+
+        def close(self):
+            pass
+
+        def checkpoint(
+            self, last_committed: dict[str, object] | None
+        ) -> dict[str, object]:
+            return {
+                "uri": self._uri,
+                "buffer_size": self._buffer_size,
+                "sort": self._sort,
+                "q": self._q,
+                "fq": self._fq,
+                "fl": self._fl,
+                "stream_parse": self._stream_parse,
+                "last_committed": last_committed,
+            }
+
+        def save(self, f: TextIOWrapper, last_committed: dict[str, object] | None):
+            json.dump(self.checkpoint(last_committed), f, indent=4)
+
+    def construct_atomic_update(
+        self, doc_id: str, updates: dict[str, object]
+    ) -> dict[str, object]:
+        constructed_updates: dict[str, object] = {"id": doc_id}
+
+        for key, value in updates.items():
+            constructed_updates[key] = {"set": value}
+        return constructed_updates
+
+    def encode_atomic_update(self, doc_id: str, updates: dict[str, object]) -> bytes:
+        fields = [f'"id":{json.dumps(doc_id)}']
+        for key, value in updates.items():
+            encoded = value if isinstance(value, RawJSON) else json.dumps(value)
+            fields.append(f'{json.dumps(key)}:{{"set":{encoded}}}')
+        return ("{" + ",".join(fields) + "}").encode("utf-8")
+
+    def post_update(self, payload: bytes | str, commit_within: int | None = 1000):
+        params = {}
+        if commit_within is not None:
+            params["commitWithin"] = commit_within
+
+        try:
+            response = self.session.post(
+                f"{self._uri}/update",
+                params=params,
+                data=payload,
+                headers={"Content-Type": "application/json"},
+                timeout=self._timeout,
+            )
+        except requests.RequestException as e:
+            logger.error(f"Failed to send atomic update to solr: {e}")
+            return False
+        if response.status_code != 200:
+            logger.error(
+                f"Failed to send atomic update to solr. Status: {response.status_code}. Response: {response.text}"
+            )
+            return False
+        return True
+
+    def atomic_update(
+        self,
+        doc_id: str,
+        updates: dict[str, object],
+        commit_within: int | None = 1000,
+    ):
+        if not updates:
+            logger.warning(f"Recieved empty updates for document ID: '{doc_id}'")
+            return False
+        return self.atomic_update_many([(doc_id, updates)], commit_within)
+
+    def atomic_update_many(
+        self,
+        docs: list[tuple[str, dict[str, object]]],
+        commit_within: int | None = 1000,
+    ):
+        encoded_docs = []
+        for doc_id, updates in docs:
+            if not updates:
+                logger.warning(f"Recieved empty updates for document ID: '{doc_id}'")
+                continue
+            encoded_docs.append(self.encode_atomic_update(doc_id, updates))
+        if not encoded_docs:
+            return False
+
+        payload = b"[" + b",".join(encoded_docs) + b"]"
+        return self.post_update(payload, commit_within)
+
+    def commit(self):
+        try:
+            response = self.session.post(
+                f"{self._uri}/update",
+                params={"commit": "true"},
+                data=json.dumps({"commit": {}}),
+                headers={"Content-Type": "application/json"},
+                timeout=self._timeout,
+            )
+        except requests.RequestException as e:
+            logger.error(f"Failed to commit solr collection: {e}")
+            return False
+        if response.status_code != 200:
+            logger.error(
+                f"Failed to commit solr collection. Status: {response.status_code}. Response: {response.text}"
+            )
+            return False
+        return True
+
+    class _PrefetchingCursor(_Cursor):
+        def __init__(
+            self,
+            solr,
+            q,
+            buffer_size,
+            cursor,
+            sort,
+            total_scrolled,
+            prefetch_pages,
+            fq=None,
+            fl=None,
+            stream_parse=False,
+            after_id=None,
+            skip=0,
+        ) -> None:
+            super().__init__(
+                solr,
+                q,
+                buffer_size,
+                cursor,
+                sort,
+                total_scrolled,
+                fq,
+                fl,
+                stream_parse,
+                after_id,
+                skip,
+            )
+            self._prefetch_pages = prefetch_pages
+            self._pages: Queue = Queue(maxsize=prefetch_pages)
+            self._stop = Event()
+            self._thread: Thread | None = None
+            self._exhausted = False
+
+        def _next_page(self):
+            if self._exhausted:
+                return None
+            if self._thread is None:
+                self._thread = Thread(
+                    target=self._prefetch,
+                    args=(self._cursor, self._pages, self._stop),
+                    name="SolrPrefetcher",
+                    daemon=True,
+                )
+                self._thread.start()
+
+            page = self._pages.get()
+            prefetch_queue_depth.set(self._pages.qsize())
+            if page is None or isinstance(page, Exception):
+                self._exhausted = True
+            if isinstance(page, Exception):
+                raise page
+            return page
+
+        def _prefetch(self, cursor_mark: str, pages: Queue, stop: Event):
+            while not stop.is_set():
+                try:
+                    page = self._fetch_page(cursor_mark)
+                except Exception as e:
+                    logger.error(f"Prefetching solr page failed: {e}")
+                    self._put(e, pages, stop)
+                    return
+
+                self._put(page, pages, stop)
+                if page is None:
+                    return
+                cursor_mark = page[1]
+
+        def _put(self, page, pages: Queue, stop: Event):
+            while not stop.is_set():
+                try:
+                    pages.put(page, timeout=0.1)
+                    prefetch_queue_depth.set(pages.qsize())
+                    return
+                except Full:
+                    continue
+
+        def reset(self):
+            self.close()
+            super().reset()
+            self._pages = Queue(maxsize=self._prefetch_pages)
+            self._stop = Event()
+            self._exhausted = False
+
+        def close(self):
+            self._stop.set()
+            if self._thread is not None:
+                self._thread.join()
+                self._thread = None
+
+    def cursor(
+        self,
+        q="*:*",
+        buffer_size=10,
+        sort="id asc",
+        cursorMark="*",
+        total_scrolled=0,
+        prefetch_pages=0,
+        fq=None,
+        fl=None,
+        stream_parse=False,
+        after_id=None,
+        skip=0,
+    ):
+        if prefetch_pages > 0:
+            return Solr._PrefetchingCursor(
+                self,
+                q,
+                buffer_size,
+                cursorMark,
+                sort,
+                total_scrolled,
+                prefetch_pages,
+                fq,
+                fl,
+                stream_parse,
+                after_id,
+                skip,
+            )
+        return Solr._Cursor(
+            self,
+            q,
+            buffer_size,
+            cursorMark,
+            sort,
+            total_scrolled,
+            fq,
+            fl,
+            stream_parse,
+            after_id,
+            skip,
+        )
+
+    def query(self, params: dict[str, object]) -> requests.Response:
+        return self.session.post(
+            f"{self._uri}/query",
+            json={"params": params},
+            headers={"Content-type": "application/json"},
+            timeout=self._timeout,
+        )
+
+    def get_documents(
+        self, doc_ids: list[str], fl: list[str]
+    ) -> list[dict[str, object]] | None:
+        try:
+            response = self.query(
+                {
+                    "q": "{!terms f=id v=$ids}",
+                    "ids": ",".join(doc_ids),
+                    "fl": ",".join(fl),
+                    "rows": len(doc_ids),
+                    "omitHeader": "true",
+                }
+            )
+        except requests.RequestException as e:
+            logger.error(f"Failed to look up documents in solr: {e}")
+            return None
+        if response.status_code != 200:
+            logger.error(
+                f"Failed to look up documents in solr. Status: {response.status_code}. Response: {response.text}"
+            )
+            return None
+        return response.json()["response"]["docs"]
+
+    def resumedCursor(self, f: TextIOWrapper, prefetch_pages=0):
+        data: dict[str, object] = json.load(f)
+        uri = str(data.get("uri", ""))
+        buffer_size = data.get("buffer_size", -1)
+        sort = str(data.get("sort", ""))
+        q = str(data.get("q", ""))
+        fq = data.get("fq", [])
+        fl = data.get("fl", [])
+        stream_parse = bool(data.get("stream_parse", False))
+        last_committed = data.get("last_committed")
+
+        if (
+            not isinstance(buffer_size, int)
+            or not isinstance(fq, list)
+            or not isinstance(fl, list)
+            or not isinstance(last_committed, dict | None)
+        ):
+            logger.warning("Malformed cursor checkpoint. Returning new cursor.")
+            return self.cursor(prefetch_pages=prefetch_pages)
+
+        if not uri or buffer_size == -1 or not sort or not q:
+            logger.warning("Malformed cursor checkpoint. Returning new cursor.")
+            return self.cursor(prefetch_pages=prefetch_pages)
+
+        if uri != self._uri:
+            logger.warning("Invalid Solr Uri. Returning new cursor.")
+            return self.cursor(prefetch_pages=prefetch_pages)
+
+        create = partial(
+            self.cursor,
+            q,
+            buffer_size,
+            sort,
+            prefetch_pages=prefetch_pages,
+            fq=fq,
+            fl=fl,
+            stream_parse=stream_parse,
+        )
+
+        if "last_committed" not in data:
+            # Checkpoints written before exact resumption only know the page
+            # they were on, so that page is indexed again.
+            cursorMark = str(data.get("cursor", "")) or "*"
+            total_scrolled = data.get("total_scrolled", 0)
+            logger.warning("Legacy checkpoint. Re-indexing its last page...")
+            return create(cursorMark=cursorMark, total_scrolled=total_scrolled)
+
+        if last_committed is None:
+            logger.info(
+                "No document was committed before the checkpoint. Starting over..."
+            )
+            return create()
+
+        doc_id = last_committed.get("id")
+        position = last_committed.get("position")
+        page_mark = last_committed.get("page_mark")
+        page_offset = last_committed.get("page_offset")
+        if (
+            not isinstance(position, int)
+            or not isinstance(page_mark, str)
+            or not isinstance(page_offset, int)
+        ):
+            logger.warning("Malformed cursor checkpoint. Returning new cursor.")
+            return self.cursor(prefetch_pages=prefetch_pages)
+
+        if id_sort_direction(sort) is not None and isinstance(doc_id, str):
+            logger.info(f"Resuming after document ID: '{doc_id}'...")
+            cursor = create(total_scrolled=position, after_id=doc_id)
+        else:
+            logger.info(
+                f"Resuming after document {page_offset + 1} of page '{page_mark}'..."
+            )
+            cursor = create(
+                cursorMark=page_mark, total_scrolled=position, skip=page_offset + 1
+            )
+        cursor.resumed_from = last_committed
+        return cursor
+
+
+class BufferedUpdater:
+    def __init__(
+        self,
+        solr: Solr,
+        max_docs: int = 100,
+        max_bytes: int = 5_000_000,
+        commit_within: int | None = 1000,
+        on_flush: Callable[[list[str], bool], None] | None = None,
+    ) -> None:
+        self._solr = solr
+        self._max_docs = max_docs
+        self._max_bytes = max_bytes
+        self._commit_within = commit_within
+        self._on_flush = on_flush
+        self._pending_docs: list[bytes] = []
+        self._pending_ids: list[str] = []
+        self._pending_bytes = 0
+        self._batch_number = 0
+        self.updated_count = 0
+        self.failed_count = 0
+
+    def add(self, doc_id: str, updates: dict[str, object]):
+        if not updates:
+            logger.warning(f"Recieved empty updates for document ID: '{doc_id}'")
+            self.failed_count += 1
+            return False
+
+        doc = self._solr.encode_atomic_update(doc_id, updates)
+        if self._pending_docs and self._pending_bytes + len(doc) > self._max_bytes:
+            self.flush()
+
+        self._pending_docs.append(doc)
+        self._pending_ids.append(doc_id)
+        self._pending_bytes += len(doc) + 1
+
+        if (
+            len(self._pending_docs) >= self._max_docs
+            or self._pending_bytes >= self._max_bytes
+        ):
+            return self.flush()
+        return True
+
+    def flush(self):
+        if not self._pending_docs:
+            return True
+
+        self._batch_number += 1
+        doc_ids = self._pending_ids
+        payload = b"[" + b",".join(self._pending_docs) + b"]"
+        self._pending_docs = []
+        self._pending_ids = []
+        self._pending_bytes = 0
+
+        logger.debug(
+            f"Sending update batch #{self._batch_number} with {len(doc_ids)} documents ({len(payload)} bytes)..."
+        )
+        with update_seconds.time():
+            try:
+                succeeded = self._solr.post_update(payload, self._commit_within)
+            except Exception as e:
+                logger.error(f"Update batch #{self._batch_number} raised: {e}")
+                succeeded = False
+        update_batch_documents.observe(len(doc_ids))
+        if succeeded:
+            logger.debug(
+                f"Successfully updated batch #{self._batch_number} with {len(doc_ids)} documents."
+            )
+            self.updated_count += len(doc_ids)
+            updated_documents.inc(len(doc_ids))
+        else:
+            logger.error(
+                f"Failed to update batch #{self._batch_number}. Document IDs: {doc_ids}"
+            )
+            self.failed_count += len(doc_ids)
+            failed_documents.inc(len(doc_ids))
+
+        if self._on_flush is not None:
+            self._on_flush(doc_ids, succeeded)
+        return succeeded
+
+    def close(self):
+        succeeded = self.flush()
+        if self._commit_within is None:
+            logger.info("Sending final commit to solr...")
+            return self._solr.commit() and succeeded
+        return succeeded
@@ -0,0 +1,32 @@
+from functools import lru_cache
+
+import numpy as np
+
+# Nine significant digits are enough to round-trip any float32 value.
+DEFAULT_PRECISION = 9
+
+
+class RawJSON(str):
+    """Pre-encoded JSON text that is written into update payloads verbatim."""
+
+
+@lru_cache(maxsize=8)
+def _row_format(columns: int, precision: int) -> str:
+    return "[" + ",".join([f"%.{precision}g"] * columns) + "]"
+
+
+def format_vectors(
+    matrix: np.ndarray, precision: int = DEFAULT_PRECISION
+) -> list[RawJSON]:
+    """Formats every row of a matrix as a JSON array of numbers."""
+    matrix = np.asarray(matrix)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    if not np.isfinite(matrix).all():
+        raise ValueError("Vectors must not contain NaN or infinite values.")
+    row_format = _row_format(matrix.shape[1], precision)
+    return [RawJSON(row_format % tuple(row)) for row in matrix.tolist()]
+
+
+def format_vector(vector: np.ndarray, precision: int = DEFAULT_PRECISION) -> RawJSON:
+    return format_vectors(vector, precision)[0]